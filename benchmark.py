@@ -0,0 +1,958 @@
+'''
+    Timing harness for the collator. Unlike collator-test.py, nothing here
+    stops for input, so it can be run unattended and the numbers compared
+    from one version of the code to the next.
+
+    Usage:  python benchmark.py [--save REPORT] [--compare REPORT] [benchmark ...]
+
+    With no benchmarks named, every one runs. Each measurement prints one
+    line: its name, value, unit and any detail. --save writes the
+    measurements to a JSON report; --compare reads a report saved earlier
+    (say, from the last release) and prints each measurement beside the old
+    one, flagging anything that got worse by more than the tolerance.
+
+    Measurements come from the five sample volumes bundled with the collator
+    (split back into pages, see samplepages) and from synthetic books, whose
+    length, number of distinct headers and OCR noise can be set (see
+    syntheticbook).
+'''
+
+import copy
+import glob
+import importlib.util
+import os
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import zipfile
+from array import array
+from collections import Counter
+from operator import itemgetter
+
+import collator
+import filekeeping
+
+collator_directory = os.path.dirname(os.path.abspath(__file__))
+
+# Every measurement goes through record(), which prints it and keeps it here,
+# under its name, for --save and --compare.
+
+measurements = {}
+
+def record(name, value, unit, detail=''):
+    '''Prints one measurement and keeps it for the report.'''
+    measurements[name] = {'value': value, 'unit': unit}
+    print(('%-44s %12.4f %-5s %s' % (name, value, unit, detail)).rstrip())
+
+# Units in which a bigger number is better; in every other unit (seconds,
+# milliseconds, kilobytes) smaller is better.
+
+higherisbetter = {'MB/s'}
+
+def compare(report, tolerance=.2):
+    '''Prints each measurement in this run beside the same one in an older
+    report, as a ratio of new to old, and flags those that got worse by more
+    than tolerance (a fraction). Returns the names of the ones flagged.'''
+    worse = []
+    for name, measurement in measurements.items():
+        if name not in report:
+            continue
+        old = report[name]['value']
+        new = measurement['value']
+        if old <= 0:
+            continue
+        ratio = new / old
+        if measurement['unit'] in higherisbetter:
+            regressed = ratio < 1 - tolerance
+        else:
+            regressed = ratio > 1 + tolerance
+        flag = 'WORSE' if regressed else ''
+        print(('%-44s %12.4f -> %12.4f %-5s x%6.2f %s' % (name, old, new, measurement['unit'], ratio, flag)).rstrip())
+        if regressed:
+            worse.append(name)
+    return worse
+
+def importlatency(modulename, repeats=20, code=None):
+    ''' Measures how long a fresh interpreter takes to import modulename,
+    net of the time it takes to start an interpreter at all. Each trial
+    runs in its own subprocess (so nothing is cached in sys.modules), from
+    the collator directory. Returns the best net latency in seconds, since
+    anything slower than the best trial is noise from the machine. If code
+    is given, it is run in place of the bare import statement.'''
+
+    def trial(code):
+        timings = []
+        for i in range(repeats):
+            start = time.perf_counter()
+            subprocess.run([sys.executable, '-c', code], cwd=collator_directory,
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            timings.append(time.perf_counter() - start)
+        return min(timings)
+
+    baseline = trial('pass')
+    if code is None:
+        code = 'import ' + modulename
+    loaded = trial(code)
+    return loaded - baseline
+
+# What importing collator used to cost, before configuration was loaded
+# lazily: the modules the old collator imported at the top, plus reading
+# PathDictionary.txt and resolving the pairtree root.  (The old import also
+# ran the driver loop over HTids_toprocess, which needs a pairtree on disk,
+# so that part isn't reproduced here.)
+
+eagerimport = ('import glob, multiprocessing, traceback, collator; '
+               'collator.getpairtreeroot()')
+
+def bench_import():
+    ''' Startup cost of importing the collator as a library, beside the
+    cost of the eager configuration the import used to do. Bytecode is
+    written first, so that compiling the source (which an interpreter run
+    with PYTHONDONTWRITEBYTECODE would otherwise redo in every trial) isn't
+    counted as import time. '''
+    import py_compile
+    for modulename in ['filekeeping', 'collator']:
+        py_compile.compile(os.path.join(collator_directory, modulename + '.py'))
+    for modulename in ['filekeeping', 'collator']:
+        latency = importlatency(modulename)
+        record('import/' + modulename, latency * 1000, 'ms')
+    latency = importlatency('collator', code=eagerimport)
+    record('import/collator-eager', latency * 1000, 'ms')
+
+letters = 'abcdefghijklmnopqrstuvwxyz'
+ocrjunk = letters + letters.upper() + "     .,;:'!-~^*&%$#"
+
+def noisyheaders(pages, distinct, seed=0):
+    '''Returns a list of page headers, one per page, for a synthetic
+    volume: a running title on every other page, chapter titles on the rest,
+    and enough random OCR garbage sprinkled over the pages to make about
+    `distinct` different headers in all.'''
+
+    generator = random.Random(seed)
+    chapters = ['chapter the ' + word for word in
+                ['first', 'second', 'third', 'fourth', 'fifth', 'sixth']]
+    headers = []
+
+    garbage_rate = min(1.0, distinct / pages)
+    for page in range(pages):
+        if generator.random() < garbage_rate:
+            length = generator.randint(5, 30)
+            junk = ''.join(generator.choice(ocrjunk) for i in range(length))
+            headers.append(junk.strip('1234567890. ,"\t\n').lower())
+        elif page % 2 == 0:
+            headers.append('a synthetic title')
+        else:
+            headers.append(chapters[page * len(chapters) // pages])
+
+    return headers
+
+lexicon = ['the', 'of', 'and', 'to', 'a', 'in', 'that', 'was', 'he', 'his', 'it',
+           'with', 'for', 'as', 'had', 'which', 'her', 'not', 'but', 'by', 'upon',
+           'house', 'morning', 'letter', 'river', 'country', 'silence', 'remembered']
+
+def ocrnoise(text, generator):
+    '''Garbles one to three characters of text the way OCR does.'''
+    characters = list(text)
+    for i in range(generator.randint(1, 3)):
+        position = generator.randrange(len(characters))
+        characters[position] = generator.choice(ocrjunk)
+    return ''.join(characters)
+
+def syntheticbook(pages=400, vocabulary=12, noise=.05, wordsperpage=300, seed=0):
+    '''Returns a synthetic volume as a list of pages, each a list of lines,
+    laid out like the sample volumes: the chapter's title at the top of even
+    pages, and a page number over the book's title at the top of odd ones.
+    There are `vocabulary` chapters, of equal length, and so that many
+    distinct running headers besides the title. Each running header is
+    garbled by OCR noise with probability `noise`. The body of each page is
+    `wordsperpage` words drawn from a small lexicon, ten to a line.'''
+
+    generator = random.Random(seed)
+    title = 'THE SYNTHETIC VOLUME'
+    chapters = ['CHAPTER ' + str(number + 1) + ' ' + generator.choice(lexicon).upper()
+                for number in range(vocabulary)]
+    pagelist = []
+
+    for page in range(pages):
+        if page % 2 == 0:
+            header = chapters[page * vocabulary // pages]
+        else:
+            header = title
+        if generator.random() < noise:
+            header = ocrnoise(header, generator)
+        if page % 2 == 0:
+            lines = [header + '\n']
+        else:
+            lines = [str(page) + '\n', header + '\n']
+
+        words = [generator.choice(lexicon) for i in range(wordsperpage)]
+        for start in range(0, wordsperpage, 10):
+            lines.append(' '.join(words[start:start + 10]) + '\n')
+        pagelist.append(lines)
+
+    return pagelist
+
+def headersequence(pageheaders):
+    '''Orders headers by frequency, the way collate() does.'''
+    counts = Counter(pageheaders)
+    return sorted(counts.items(), key = itemgetter(1), reverse = True)
+
+def samplevolumes():
+    '''Paths of the collated sample volumes bundled with the collator.'''
+    return sorted(glob.glob(os.path.join(collator_directory, '0*.txt')))
+
+def samplepages(path):
+    '''Splits one of the bundled collated volumes back into a list of
+    pages, each a list of lines, the way they'd be read from the pairtree.
+    Collation took the running headers out, so they are put back: the name
+    of the page's <div> on even pages, and a page number above a running
+    title on odd ones. A volume collated as one 'Fulltext' <div> had no
+    running headers, and gets none.'''
+
+    pagelist = []
+    page = []
+    section = None
+
+    with open(path, encoding='utf-8') as file:
+        for line in file:
+            opening = re.match('<div id="(.*?)"', line)
+            if opening:
+                section = opening.group(1)
+            elif line == '</div>\n':
+                continue
+            elif line == '<pb>\n':
+                if section != 'Fulltext' and len(pagelist) % 2 == 0:
+                    page.insert(0, section.upper() + '\n')
+                elif section != 'Fulltext':
+                    page[0:0] = [str(len(pagelist)) + '\n', 'THE SAMPLE VOLUME\n']
+                pagelist.append(page)
+                page = []
+            else:
+                page.append(line)
+
+    return pagelist
+
+def writepairtree(rootpath, volumes):
+    '''Writes volumes (a dictionary of HTid -> pagelist) into a pairtree
+    structure under rootpath, one file per page, named by page sequence
+    the way HathiTrust names them.'''
+    for HTid, pagelist in volumes.items():
+        path, postfix = filekeeping.pairtreepath(HTid, rootpath)
+        pagepath = path + postfix + "/" + postfix + "/"
+        os.makedirs(pagepath, exist_ok=True)
+        for idx, page in enumerate(pagelist):
+            with open(pagepath + '%08d.txt' % (idx + 1), mode='w', encoding='utf-8') as file:
+                file.writelines(page)
+
+def samplepairtree(rootpath):
+    '''Writes the bundled sample volumes into a pairtree under rootpath,
+    as pst.<filename>, and returns their HTids.'''
+    volumes = {}
+    for path in samplevolumes():
+        HTid = 'pst.' + os.path.basename(path)[:-4]
+        volumes[HTid] = samplepages(path)
+    writepairtree(rootpath, volumes)
+    return list(volumes)
+
+def timed(function, *args, **kwargs):
+    '''Calls function once and returns (seconds, result).'''
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+def backends():
+    '''The header-clustering backends that can run here.'''
+    available = ['scan', 'index']
+    if importlib.util.find_spec('numpy') is not None:
+        available.append('numpy')
+    return available
+
+def bench_dice():
+    ''' Times the vectorized bitset Dice scores against dicecoefficient()
+    on every pair of a few hundred noisy headers. regression.py checks
+    that they agree. '''
+    if 'numpy' not in backends():
+        print('dice   numpy is not installed; skipped')
+        return
+
+    headers = sorted(set(noisyheaders(600, 600, seed = 1)))
+    headers += ['chapter i', 'chapter ii', 'introduction', 'préface', '$$', '']
+    bigramsets = [collator.getbigrams(header) for header in headers]
+    bitsets, sizes = collator.bigrambitsets(headers)
+
+    start = time.perf_counter()
+    expected = [[collator.dicecoefficient(first, second) for second in bigramsets]
+                for first in bigramsets]
+    python_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    scores = [collator.bitsetdice(bitsets[idx], sizes[idx], bitsets, sizes)
+              for idx in range(len(headers))]
+    numpy_seconds = time.perf_counter() - start
+
+    pairs = len(headers) * len(headers)
+    record('dice/%d-pairs/python' % pairs, python_seconds, 's')
+    record('dice/%d-pairs/numpy' % pairs, numpy_seconds, 's')
+
+def bench_cluster():
+    ''' Header clustering on synthetic volumes with thousands of distinct
+    noisy headers. Every backend must agree with the all-pairs scan. '''
+    for pages, distinct in [(2000, 1000), (6000, 5000), (12000, 10000)]:
+        sequence = headersequence(noisyheaders(pages, distinct))
+        reference = None
+        for backend in backends():
+            if backend == 'scan' and len(sequence) > 6000:
+                continue
+            seconds, result = timed(collator.clusterheaders, sequence, backend)
+            if reference is None:
+                reference = result
+            elif result != reference:
+                raise AssertionError(backend + ' backend disagrees with scan')
+            record('cluster/%d-headers/%s' % (len(sequence), backend), seconds, 's')
+
+def pagecodes(pages, distinct, seed=0):
+    '''Header codes for a synthetic run of volumes of the given number of
+    pages: a running title (code 0) on odd pages and, on even ones, one of
+    distinct chapter codes, each held for a run of pages, with a stray code
+    now and then, as OCR errors leave.'''
+    generator = random.Random(seed)
+    codes = array('q')
+    chapter = 1
+    while len(codes) < pages:
+        if len(codes) % 2 == 1:
+            codes.append(0)
+        elif generator.random() < .05:
+            codes.append(generator.randrange(distinct))
+        else:
+            if generator.random() < .02:
+                chapter = generator.randrange(1, distinct)
+            codes.append(chapter)
+    return codes
+
+def bench_pairs():
+    ''' Counting pairs of header codes on neighbouring pages, up to runs of
+    volumes 100,000 pages long. The numpy backend must agree with the
+    others, key order included. '''
+    for pages, distinct in [(1000, 20), (10000, 200), (100000, 2000)]:
+        codes = pagecodes(pages, distinct)
+        reference = None
+        for backend in ['index', 'numpy']:
+            if backend not in backends():
+                continue
+            seconds = besttime(5, collator.countpairs, codes, backend)
+            result = collator.countpairs(codes, backend)
+            if reference is None:
+                reference = result
+            elif list(result.items()) != list(reference.items()):
+                raise AssertionError(backend + ' pair counts disagree')
+            record('pairs/%d-pages/%s' % (pages, backend), seconds, 's', '%d pairs' % len(result))
+
+def bench_cache():
+    ''' Header clustering over a run of volumes that share their running
+    headers, with the header bigram cache on and off. '''
+    volumes = [headersequence(noisyheaders(500, 50, seed = seed)) for seed in range(40)]
+
+    for backend in backends():
+        collator.clusterheaders(volumes[0], backend)     # warm up imports
+        for label, sizes in [('cached', {}), ('uncached', {'bigramsize': 0})]:
+            collator.configurecache(**sizes)
+            start = time.perf_counter()
+            for sequence in volumes:
+                collator.clusterheaders(sequence, backend)
+            seconds = time.perf_counter() - start
+
+            stats = collator.cachestats()
+            record('cache/%s/%s' % (backend, label), seconds, 's',
+                   'bigram hits %d misses %d' % (stats['bigrams']['hits'], stats['bigrams']['misses']))
+
+    collator.configurecache()
+
+def quadraticrepair(sectioncodes):
+    '''The invalid-section repair loop as segment() used to run it, kept
+    to check and time collator.repairsections() against. It rescans forward
+    from every invalid page.'''
+    lastsection = 0
+    lastknowndex = 0
+
+    for idx,page in enumerate(sectioncodes):
+        if page != 999:
+            lastsection = page
+            lastknowndex = idx
+        elif idx == 0:
+            for replace in sectioncodes:
+                if replace != 999:
+                    sectioncodes[idx] = replace
+                    lastknowndex = idx
+                    break
+        elif idx == len(sectioncodes) - 1:
+            sectioncodes[idx] = sectioncodes[idx - 1]
+        else:
+            count = 0
+            for replace in sectioncodes[idx:]:
+                count += 1
+                if replace != 999:
+                    break
+            if (idx - lastknowndex) > count:
+                sectioncodes[idx] = sectioncodes[idx + count]
+                lastsection = page
+                lastknowndex = idx
+            elif (idx - lastknowndex) < count:
+                sectioncodes[idx] = lastsection
+                lastknowndex = idx
+            else:
+                raise AssertionError('the tie-breaking branch was reached')
+
+    return sectioncodes
+
+def gappedcodes(pages, gap, seed=0):
+    '''Section codes for a synthetic volume of the given number of pages,
+    alternating runs of valid codes with runs of gap invalid (999) pages.'''
+    generator = random.Random(seed)
+    codes = []
+    while len(codes) < pages:
+        codes.extend([generator.randrange(20)] * generator.randint(1, 50))
+        codes.extend([999] * gap)
+    return codes[:pages]
+
+def bench_repair():
+    ''' Repair of invalid (999) section codes, old and new, timed on
+    50,000-page volumes with long invalid runs. regression.py checks that
+    they agree. '''
+    for gap in [10, 100, 1000, 5000]:
+        codes = gappedcodes(50000, gap)
+        for label, function in [('old', quadraticrepair), ('new', collator.repairsections)]:
+            seconds, result = timed(function, list(codes))
+            record('repair/50000-pages/gap-%d/%s' % (gap, label), seconds, 's')
+
+def tracedpeak(function, *args):
+    '''Calls function and returns (peak bytes allocated during the call,
+    result), as traced by tracemalloc.'''
+    tracemalloc.start()
+    try:
+        result = function(*args)
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak, result
+
+def inmemorycollate(HTid, rootpath, outputdir):
+    '''The whole-volume path: load every page, collate, write.'''
+    pagelist = filekeeping.loadpagelist(HTid, rootpath)
+    return filekeeping.writecollated(HTid, collator.collate(pagelist), outputdir)
+
+def bench_memory():
+    ''' Peak memory of collating the sample volumes from a pairtree, with
+    every page in memory and streamed a page at a time. regression.py
+    checks that streaming gives the same file and doesn't hold pages. '''
+    with tempfile.TemporaryDirectory() as scratch:
+        rootpath = os.path.join(scratch, 'collection') + '/'
+        htids = samplepairtree(rootpath)
+        for HTid in htids:
+            pagepaths = filekeeping.pagefilepaths(HTid, rootpath)
+            largestpage = max(os.path.getsize(path) for path in pagepaths)
+
+            for label, function in [('whole', inmemorycollate), ('stream', collator.streamcollate)]:
+                outputdir = os.path.join(scratch, label)
+                os.makedirs(outputdir, exist_ok=True)
+                peak, outpath = tracedpeak(function, HTid, rootpath, outputdir)
+                record('memory/%s/%s' % (HTid, label), peak / 1024, 'KB',
+                       'largest page %.1f KB, %d pages' % (largestpage / 1024, len(pagepaths)))
+
+def bench_listing():
+    ''' Listing and ordering the page files of a 5,000-page volume: the
+    old os.listdir plus a sort of the names, against filekeeping's loader,
+    which also drops anything that isn't a page file. '''
+    with tempfile.TemporaryDirectory() as scratch:
+        rootpath = os.path.join(scratch, 'collection') + '/'
+        HTid = 'pst.000000000001'
+        writepairtree(rootpath, {HTid: [['page\n']] * 5000})
+        path, postfix = filekeeping.pairtreepath(HTid, rootpath)
+        pagepath = path + postfix + "/" + postfix + "/"
+        for name in ['.DS_Store', 'notes', 'pagedata.xml']:
+            open(pagepath + name, 'w').close()
+
+        def listandsort():
+            return [pagepath + f for f in sorted(os.listdir(pagepath)) if f[0] != "."]
+
+        for label, function, args in [('listdir+sort', listandsort, ()),
+                                      ('ordered', filekeeping.pagefilepaths, (HTid, rootpath))]:
+            trials = [timed(function, *args) for i in range(50)]
+            seconds = min(trial[0] for trial in trials)
+            record('listing/5000-pages/' + label, seconds * 1000, 'ms', '%d files' % len(trials[0][1]))
+
+def bench_archive():
+    ''' Loading the sample volumes from loose page files, from a zip of
+    each volume (with no loose pages beside it), from a .tar.gz of each
+    with its pages stored in order and then in reverse, and from a packed
+    page corpus of each. All must give the same pages. '''
+    import tarfile
+
+    with tempfile.TemporaryDirectory() as scratch:
+        looseroot = os.path.join(scratch, 'loose') + '/'
+        ziproot = os.path.join(scratch, 'zipped') + '/'
+        tarroot = os.path.join(scratch, 'tarred') + '/'
+        reversedroot = os.path.join(scratch, 'reversed') + '/'
+        corpusroot = os.path.join(scratch, 'packed') + '/'
+        htids = samplepairtree(looseroot)
+
+        samplepairtree(corpusroot)
+        for HTid in htids:
+            filekeeping.packvolume(HTid, corpusroot)
+            path, postfix = filekeeping.pairtreepath(HTid, corpusroot)
+            shutil.rmtree(path + postfix + '/' + postfix)
+
+        for HTid in htids:
+            path, postfix = filekeeping.pairtreepath(HTid, ziproot)
+            os.makedirs(path + postfix)
+            with zipfile.ZipFile(path + postfix + '/' + postfix + '.zip', 'w', zipfile.ZIP_DEFLATED) as archive:
+                for pagefile in filekeeping.pagefilepaths(HTid, looseroot):
+                    archive.write(pagefile, postfix + '/' + os.path.basename(pagefile))
+
+        for rootpath, order in [(tarroot, 1), (reversedroot, -1)]:
+            for HTid in htids:
+                path, postfix = filekeeping.pairtreepath(HTid, rootpath)
+                os.makedirs(path + postfix)
+                with tarfile.open(path + postfix + '/' + postfix + '.tar.gz', 'w:gz') as archive:
+                    for pagefile in filekeeping.pagefilepaths(HTid, looseroot)[::order]:
+                        archive.add(pagefile, postfix + '/' + os.path.basename(pagefile))
+
+        for label, rootpath in [('loose', looseroot), ('zip', ziproot), ('tar.gz', tarroot),
+                                ('tar.gz-reversed', reversedroot), ('corpus', corpusroot)]:
+            start = time.perf_counter()
+            volumes = [filekeeping.loadpagelist(HTid, rootpath) for HTid in htids]
+            seconds = time.perf_counter() - start
+            if label == 'loose':
+                expected = volumes
+            elif volumes != expected:
+                raise AssertionError(label + ' volumes read differently')
+            pages = sum(len(pagelist) for pagelist in volumes)
+            record('archive/' + label, seconds, 's', '%d pages' % pages)
+
+def linebylinewrite(HTid, pagelist, outputdir):
+    '''The old writer: one write call per line, straight to the final
+    file.'''
+    outpath = os.path.join(outputdir, HTid[4:] + ".txt")
+    with open(outpath,mode='w',encoding='utf-8') as file:
+        for page in pagelist:
+            for line in page:
+                file.write(line)
+    return outpath
+
+def bench_output():
+    ''' Throughput of writing the collated sample volumes: the old
+    line-by-line writer, then filekeeping.writecollated plain and with each
+    kind of compression that can run here. '''
+    volumes = {}
+    for path in samplevolumes():
+        volumes['pst.' + os.path.basename(path)[:-4]] = collator.collate(samplepages(path))
+    megabytes = sum(len(''.join(line for page in pagelist for line in page).encode('utf-8'))
+                    for pagelist in volumes.values()) / 1e6
+
+    writers = [('line-by-line', linebylinewrite, None), ('joined', filekeeping.writecollated, None),
+               ('gzip', filekeeping.writecollated, 'gzip')]
+    if importlib.util.find_spec('zstandard') is not None:
+        writers.append(('zstd', filekeeping.writecollated, 'zstd'))
+
+    with tempfile.TemporaryDirectory() as outputdir:
+        for label, writer, compression in writers:
+            trials = []
+            for trial in range(20):
+                start = time.perf_counter()
+                written = 0
+                for HTid, pagelist in volumes.items():
+                    if compression is None:
+                        outpath = writer(HTid, pagelist, outputdir)
+                    else:
+                        outpath = writer(HTid, pagelist, outputdir, compression)
+                    written += os.path.getsize(outpath)
+                trials.append(time.perf_counter() - start)
+            seconds = min(trials)
+            record('output/' + label, megabytes / seconds, 'MB/s',
+                   '%.2f MB of text -> %.2f MB on disk' % (megabytes, written / 1e6))
+
+def bench_incremental():
+    ''' A full run of main() with --incremental over the sample volumes,
+    a rerun with nothing changed, and a rerun after one volume's pages
+    are touched. Only the touched volume may be recollated. '''
+    with tempfile.TemporaryDirectory() as scratch:
+        rootpath = os.path.join(scratch, 'collection') + '/'
+        outputdir = os.path.join(scratch, 'output')
+        os.makedirs(outputdir)
+        htids = samplepairtree(rootpath)
+        argv = htids + ['--root', rootpath, '--output', outputdir, '--incremental']
+
+        seconds, result = timed(collator.main, argv)
+        record('incremental/full', seconds, 's')
+        seconds, result = timed(collator.main, argv)
+        record('incremental/unchanged', seconds, 's')
+
+        pagefile = filekeeping.pagefilepaths(htids[0], rootpath)[0]
+        os.utime(pagefile, ns=(time.time_ns(), time.time_ns() + 10**9))
+        manifest = filekeeping.loadmanifest(os.path.join(outputdir, collator.manifestname))
+        stale, keys = collator.stalevolumes(htids, rootpath, outputdir, manifest)
+        if stale != htids[:1]:
+            raise AssertionError('expected only ' + htids[0] + ' to be stale, got ' + str(stale))
+        seconds, result = timed(collator.main, argv)
+        record('incremental/one-touched', seconds, 's')
+
+def bench_stages():
+    ''' Where collate() spends its time on the sample volumes, from the
+    stats it records when asked, and what asking costs: collate() timed
+    with and without a stats dictionary. '''
+    volumes = [samplepages(path) for path in samplevolumes()]
+    collator.collate(copy.deepcopy(volumes[0]))        # warm up
+
+    trials = {'off': [], 'on': []}
+    for trial in range(10):
+        for label in trials:
+            pagelists = copy.deepcopy(volumes)
+            totals = {}
+            start = time.perf_counter()
+            for pagelist in pagelists:
+                if label == 'on':
+                    stats = {}
+                    collator.collate(pagelist, stats = stats)
+                    collator.addvolumestats(totals, stats)
+                else:
+                    collator.collate(pagelist)
+            trials[label].append(time.perf_counter() - start)
+            if label == 'on':
+                stagetotals = totals
+
+    for label, seconds in trials.items():
+        record('stages/stats-' + label, min(seconds), 's')
+    for stage, seconds in sorted(stagetotals['seconds'].items(), key = itemgetter(1), reverse = True):
+        record('stages/' + stage, seconds, 's')
+
+def bench_prefetch():
+    ''' A serial run of main() over the sample volumes, with and without
+    --prefetch, on a pairtree where opening each page file takes an extra
+    millisecond, as it might on a network filesystem. Both must write the
+    same files. '''
+    readpage = filekeeping.readpage
+
+    def slowreadpage(path):
+        time.sleep(.001)
+        return readpage(path)
+
+    with tempfile.TemporaryDirectory() as scratch:
+        rootpath = os.path.join(scratch, 'collection') + '/'
+        htids = samplepairtree(rootpath)
+        outputs = {}
+        filekeeping.readpage = slowreadpage
+        try:
+            for label, extra in [('serial', []), ('prefetch-2', ['--prefetch', '2']), ('prefetch-4', ['--prefetch', '4'])]:
+                outputdir = os.path.join(scratch, label)
+                os.makedirs(outputdir)
+                seconds, result = timed(collator.main, htids + ['--root', rootpath, '--output', outputdir] + extra)
+                record('prefetch/' + label, seconds, 's', '1 ms per page file')
+                outputs[label] = {}
+                for name in os.listdir(outputdir):
+                    with open(os.path.join(outputdir, name), encoding='utf-8') as file:
+                        outputs[label][name] = file.read()
+        finally:
+            filekeeping.readpage = readpage
+
+        for label, output in outputs.items():
+            if output != outputs['serial']:
+                raise AssertionError(label + ' wrote different files')
+
+def bench_pipeline():
+    ''' The sample volumes through collatepipeline() with different numbers
+    of readers, collators and writers, on a pairtree where opening each page
+    file takes an extra millisecond. Every arrangement must write the same
+    files as collating them one at a time. '''
+    readpage = filekeeping.readpage
+
+    def slowreadpage(path):
+        time.sleep(.001)
+        return readpage(path)
+
+    with tempfile.TemporaryDirectory() as scratch:
+        rootpath = os.path.join(scratch, 'collection') + '/'
+        htids = samplepairtree(rootpath)
+        expected = {HTid: ''.join(''.join(page) for page in collator.collate(filekeeping.loadpagelist(HTid, rootpath)))
+                    for HTid in htids}
+
+        filekeeping.readpage = slowreadpage
+        try:
+            for readers, collators, writers in [(1, 1, 1), (4, 1, 1), (4, 2, 1)]:
+                label = '%d-%d-%d' % (readers, collators, writers)
+                outputdir = os.path.join(scratch, label)
+                os.makedirs(outputdir)
+                report = {}
+                outcomes = collator.collatepipeline(htids, rootpath, outputdir, readers, collators, writers,
+                                                    queuesize = 2, report = report)
+                for HTid, error, volumestats in outcomes:
+                    if error is not None:
+                        raise error
+                record('pipeline/' + label, report['seconds'], 's',
+                       'collate busy %.0f%%' % (100 * report['collate']['busy'] / (collators * report['seconds'])))
+                for HTid in htids:
+                    with open(filekeeping.collatedpath(HTid, outputdir), encoding='utf-8') as file:
+                        if file.read() != expected[HTid]:
+                            raise AssertionError('pipeline ' + label + ' changed the output of ' + HTid)
+        finally:
+            filekeeping.readpage = readpage
+
+def bench_transport():
+    ''' Big synthetic volumes collated on a pool of processes, by
+    collatemany() and by collatepipeline() with two collators, with their
+    pages pickled to and from the workers and then sent in shared memory.
+    Both ways must write the same files. Also times what the parent, which
+    handles every volume in turn, does with one volume the workers send
+    back: unpickling it and writing it out. '''
+    import pickle
+
+    with tempfile.TemporaryDirectory() as scratch:
+        rootpath = os.path.join(scratch, 'collection') + '/'
+        volumes = {'bench.transport%d' % idx: syntheticbook(1000, 30, .1, seed = idx) for idx in range(8)}
+        writepairtree(rootpath, volumes)
+        htids = list(volumes)
+
+        pagelist = volumes[htids[0]]
+        outputdir = os.path.join(scratch, 'parent')
+        os.makedirs(outputdir)
+        pickled = pickle.dumps(collator.collate(pagelist), pickle.HIGHEST_PROTOCOL)
+        layouts = pickle.dumps(collator.layoutvolume(pagelist), pickle.HIGHEST_PROTOCOL)
+        trials = {'pickled': [], 'shared': []}
+        for i in range(5):
+            start = time.perf_counter()
+            filekeeping.writecollated(htids[0], pickle.loads(pickled), outputdir)
+            trials['pickled'].append(time.perf_counter() - start)
+            name = filekeeping.sharepages(pagelist)
+            start = time.perf_counter()
+            collator.writeshared(htids[0], name, pickle.loads(layouts), outputdir)
+            trials['shared'].append(time.perf_counter() - start)
+        for label, seconds in trials.items():
+            record('transport/parent/' + label, 1000 * min(seconds), 'ms', '%d bytes pickled' %
+                   len(pickled if label == 'pickled' else layouts))
+
+        outputs = {}
+        for driver in ['many', 'pipeline']:
+            for label, shared in [('pickled', False), ('shared', True)]:
+                outputdir = os.path.join(scratch, driver + '-' + label)
+                os.makedirs(outputdir)
+                start = time.perf_counter()
+                if driver == 'many':
+                    failures = collator.collatemany(htids, rootpath, outputdir, workers = 2, shared = shared)
+                    if failures:
+                        raise AssertionError('collatemany failed: ' + ', '.join(failures))
+                else:
+                    for HTid, error, volumestats in collator.collatepipeline(htids, rootpath, outputdir, 2, 2, 1,
+                                                                             shared = shared):
+                        if error is not None:
+                            raise error
+                seconds = time.perf_counter() - start
+                record('transport/' + driver + '/' + label, seconds, 's', '%d volumes of 1000 pages' % len(htids))
+                outputs[driver + '-' + label] = {}
+                for name in os.listdir(outputdir):
+                    with open(os.path.join(outputdir, name), encoding='utf-8') as file:
+                        outputs[driver + '-' + label][name] = file.read()
+
+        reference = outputs['many-pickled']
+        for label, output in outputs.items():
+            if output != reference:
+                raise AssertionError(label + ' wrote different files')
+
+def modelledmakespan(tasks, workers):
+    '''How long a pool of workers would take over tasks (a list of their
+    costs in seconds), handing each to whichever worker comes free first,
+    in the order given, as Pool.imap_unordered does.'''
+    import heapq
+
+    free = [0.0] * workers
+    for cost in tasks:
+        heapq.heappush(free, heapq.heappop(free) + cost)
+    return max(free)
+
+def bench_schedule():
+    ''' A batch of thirty small synthetic volumes with one big one at the
+    end, collated by collatemany() on two workers in the order given and
+    then scheduled by size (see collator.schedulebatch). Records each run's
+    makespan and how close it came to the best possible (see
+    collator.printbatchreport). Both must write the same files.
+
+    With fewer cores than workers, the workers take turns on the same cores
+    and any order takes about as long, so the makespans are also modelled:
+    collate() is timed on each volume on its own (reading and writing left
+    out), and modelledmakespan() works out how
+    long a pool of two or four workers would take over the volumes in the
+    order given and over the chunks schedulebatch() makes. '''
+    with tempfile.TemporaryDirectory() as scratch:
+        rootpath = os.path.join(scratch, 'collection') + '/'
+        volumes = {'bench.small%02d' % idx: syntheticbook(100, 6, .1, seed = idx) for idx in range(30)}
+        volumes['bench.big'] = syntheticbook(3000, 40, .1, seed = 99)
+        writepairtree(rootpath, volumes)
+        htids = list(volumes)
+
+        outputs = {}
+        for label, schedule in [('in-order', False), ('by-size', True)]:
+            outputdir = os.path.join(scratch, label)
+            os.makedirs(outputdir)
+            report = {}
+            failures = collator.collatemany(htids, rootpath, outputdir, workers = 2, schedule = schedule, report = report)
+            if failures:
+                raise AssertionError('collatemany failed: ' + ', '.join(failures))
+            bound = max(report['volumeseconds'] / report['workers'], report['longest'])
+            record('schedule/' + label, report['makespan'], 's', 'volumes total %.3f s, best possible %.0f%%, %d cores' %
+                   (report['volumeseconds'], 100 * bound / report['makespan'], os.cpu_count()))
+            outputs[label] = {}
+            for name in os.listdir(outputdir):
+                with open(os.path.join(outputdir, name), encoding='utf-8') as file:
+                    outputs[label][name] = file.read()
+
+        if outputs['by-size'] != outputs['in-order']:
+            raise AssertionError('scheduling by size wrote different files')
+
+        costs = {HTid: besttime(3, collator.collate, pagelist) for HTid, pagelist in volumes.items()}
+        for workers in [2, 4]:
+            scheduled, totalbytes = collator.schedulebatch(htids, rootpath, workers)
+            for label, tasks in [('in-order', [costs[HTid] for HTid in htids]),
+                                 ('by-size', [sum(costs[HTid] for HTid in chunk) for chunk in scheduled])]:
+                makespan = modelledmakespan(tasks, workers)
+                bound = max(sum(costs.values()) / workers, max(costs.values()))
+                record('schedule/modelled-%d-workers/%s' % (workers, label), makespan, 's',
+                       'best possible %.0f%%' % (100 * bound / makespan))
+
+def bench_discover():
+    ''' filekeeping.findvolumes() over a pairtree of 20,000 empty volume
+    folders under two prefixes, on one thread and on eight, with the time
+    until the first HTid comes out. Each walk must find every volume once.'''
+    with tempfile.TemporaryDirectory() as scratch:
+        rootpath = os.path.join(scratch, 'collection') + '/'
+        generator = random.Random(0)
+        htids = set()
+        while len(htids) < 20000:
+            htids.add(generator.choice(['pst', 'uc1']) + '.%012d' % generator.randrange(10 ** 12))
+        for HTid in htids:
+            path, postfix = filekeeping.pairtreepath(HTid, rootpath)
+            os.makedirs(path + postfix + '/' + postfix)
+
+        for threads in [1, 8]:
+            start = time.perf_counter()
+            found = []
+            for HTid in filekeeping.findvolumes(rootpath, threads):
+                if len(found) == 0:
+                    first = time.perf_counter() - start
+                found.append(HTid)
+            seconds = time.perf_counter() - start
+            if len(found) != len(htids) or set(found) != htids:
+                raise AssertionError('findvolumes found %d of %d volumes' % (len(set(found) & htids), len(htids)))
+            record('discover/threads-%d' % threads, seconds, 's', 'first HTid after %.1f ms' % (1000 * first))
+
+def besttime(repeats, function, *args):
+    '''Calls function repeats times, each on a fresh deep copy of args
+    (repairsections() and correctsequence() change theirs), and returns the
+    fastest time.'''
+    trials = []
+    for i in range(repeats):
+        copies = copy.deepcopy(args)
+        start = time.perf_counter()
+        function(*copies)
+        trials.append(time.perf_counter() - start)
+    return min(trials)
+
+def segmentinputs(pagelist):
+    '''The arguments plancollation() hands segment() for a volume.'''
+    pageheaders = [collator.pageheader(page) for page in pagelist]
+    wordprefix = collator.wordprefixes(collator.countwords(pagelist))
+    return headersequence(pageheaders), wordprefix, pageheaders
+
+def bench_bigrams():
+    ''' getbigrams() and dicecoefficient() on every header of the sample
+    volumes, called directly, with no cache in front of them. '''
+    headers = []
+    for path in samplevolumes():
+        headers.extend(collator.pageheader(page) for page in samplepages(path))
+    headers.extend(collator.pageheader(page) for page in syntheticbook(2000, 40, .3))
+
+    seconds = besttime(5, lambda: [collator.getbigrams(header) for header in headers])
+    record('bigrams/getbigrams', seconds / len(headers) * 1e6, 'us', '%d headers' % len(headers))
+
+    bigramsets = [collator.getbigrams(header) for header in headers]
+    pairs = list(zip(bigramsets, bigramsets[1:]))
+    seconds = besttime(5, lambda: [collator.dicecoefficient(first, second) for first, second in pairs])
+    record('bigrams/dicecoefficient', seconds / len(pairs) * 1e6, 'us', '%d pairs' % len(pairs))
+
+def bench_samples():
+    ''' Reading, collating, segmenting and writing each of the sample
+    volumes, from a pairtree. '''
+    with tempfile.TemporaryDirectory() as scratch:
+        rootpath = os.path.join(scratch, 'collection') + '/'
+        outputdir = os.path.join(scratch, 'output')
+        os.makedirs(outputdir)
+        htids = samplepairtree(rootpath)
+        for HTid in htids:
+            pagelist = filekeeping.loadpagelist(HTid, rootpath)
+            stats = {}
+            collator.collate(copy.deepcopy(pagelist), stats = stats)
+            detail = '%d pages' % len(pagelist)
+            record('samples/%s/read' % HTid, besttime(10, filekeeping.loadpagelist, HTid, rootpath), 's', detail)
+            record('samples/%s/collate' % HTid, besttime(10, collator.collate, pagelist), 's', detail)
+            if 'clusters' in stats:
+                # Volumes without running headers never reach segment().
+                record('samples/%s/segment' % HTid, besttime(10, collator.segment, *segmentinputs(pagelist)), 's', detail)
+            collated = collator.collate(copy.deepcopy(pagelist))
+            record('samples/%s/write' % HTid, besttime(10, filekeeping.writecollated, HTid, collated, outputdir), 's', detail)
+
+# Synthetic books for the 'synthetic' benchmark: pages, distinct running
+# headers, OCR noise rate.
+
+syntheticsizes = [(400, 12, .05), (2000, 40, .05), (2000, 40, .3), (10000, 120, .1)]
+
+def bench_synthetic():
+    ''' collate() and segment() on synthetic books of different lengths,
+    header vocabularies and noise rates. '''
+    for pages, vocabulary, noise in syntheticsizes:
+        pagelist = syntheticbook(pages, vocabulary, noise)
+        stats = {}
+        collator.collate(copy.deepcopy(pagelist), stats = stats)
+        name = 'synthetic/%dp-%dh-%dnoise' % (pages, vocabulary, noise * 100)
+        detail = '%d distinct headers, %d sections' % (stats['headers'], stats['sections'])
+        record(name + '/collate', besttime(3, collator.collate, pagelist), 's', detail)
+        record(name + '/segment', besttime(3, collator.segment, *segmentinputs(pagelist)), 's', detail)
+
+benchmarks = {'import': bench_import, 'dice': bench_dice, 'cluster': bench_cluster,
+              'cache': bench_cache, 'repair': bench_repair, 'memory': bench_memory,
+              'listing': bench_listing, 'archive': bench_archive, 'output': bench_output,
+              'incremental': bench_incremental, 'stages': bench_stages,
+              'bigrams': bench_bigrams, 'samples': bench_samples, 'synthetic': bench_synthetic,
+              'pairs': bench_pairs, 'prefetch': bench_prefetch, 'pipeline': bench_pipeline,
+              'transport': bench_transport, 'schedule': bench_schedule,
+              'discover': bench_discover}
+
+if __name__ == '__main__':
+    import argparse
+    import json
+
+    parser = argparse.ArgumentParser(description = 'Time the collator.')
+    parser.add_argument('benchmarks', nargs = '*',
+                        help = 'benchmarks to run (default: all): ' + ', '.join(benchmarks))
+    parser.add_argument('--save', help = 'write the measurements to this JSON report')
+    parser.add_argument('--compare', help = 'compare the measurements with this JSON report')
+    parser.add_argument('--tolerance', type = float, default = .2,
+                        help = 'how much worse a measurement may get before --compare flags it')
+    args = parser.parse_args()
+    for name in args.benchmarks:
+        if name not in benchmarks:
+            parser.error('no benchmark called ' + name)
+
+    for name in args.benchmarks or list(benchmarks):
+        benchmarks[name]()
+
+    if args.save:
+        with open(args.save, mode='w', encoding='utf-8') as file:
+            json.dump(measurements, file, indent = 1, sort_keys = True)
+
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as file:
+            report = json.load(file)
+        print()
+        worse = compare(report, args.tolerance)
+        sys.exit(len(worse) > 0)
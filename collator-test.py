@@ -44,10 +44,13 @@ else:
 ##HTids_toprocess = ['pst.000004929574']
 
 f = pairtree_rootpath + "htids.txt"
-with open(f, encoding='utf-8') as file:
-    filelines = file.readlines()
-
-HTids_toprocess = [x.rstrip() for x in filelines]
+if os.path.isfile(f):
+    with open(f, encoding='utf-8') as file:
+        filelines = file.readlines()
+    HTids_toprocess = [x.rstrip() for x in filelines]
+else:
+    # No list of HTids, so take every volume in the pairtree.
+    HTids_toprocess = list(filekeeping.findvolumes(pairtree_rootpath))
 
 # This is a special alphabet to be used in the bigram index.
 alphabet = ['$', 'a', 'b', 'c', 'd', 'e', 'f', 'g', 'h', 'i', 'j', 'k',
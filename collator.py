@@ -12,34 +12,61 @@
     They are intended to guide segmentation for topic modeling, not as permanent
     contributions to the curation of these documents.
     
-    As a library, collate() should be the only function treated as public.  When
-    merged into a larger workflow, remove the HTid for loop.
+    As a library, collate() should be the only function treated as public, along
+    with collatemany(), which runs collate() over a batch of volumes on a pool of
+    worker processes.  The HTid loop only runs when this file is executed as
+    a script, through main().
 '''
 
 import filekeeping
+import functools
 import os
+from array import array
+from collections import Counter
+from itertools import accumulate, chain, islice
 from operator import itemgetter
-
-pathdictionary = filekeeping.loadpathdictionary()
+from time import perf_counter
 
 TabChar="\t"
 
 dice_cutoff = .6
 
-if "pairtreeroot" in pathdictionary:
-    pairtree_rootpath = pathdictionary["pairtreeroot"]
-else:
-    ##   Hard-coding root path for development purposes, change this to your local root folder before running!
-    ##    pairtree_rootpath = input("What is the path to the root folder for your pairtree structure? ")
-    collator_directory = os.getcwd()
-    
-    pairtree_rootpath = collator_directory[:-8] + 'collection/'
+# Bump this whenever a change to the collator changes what it writes, so that
+# incremental runs (see stalevolumes) know to recollate everything.
+
+collatorversion = '2'
+
+# Configuration is loaded lazily, the first time a path into the pairtree is
+# needed, so that importing this module (e.g. in a pool worker) doesn't touch
+# the filesystem.  See getpairtreeroot().
+
+pathdictionary = None
 
 # Placeholder. Eventually we can put some code here that gets a list of HTids to drive
 # the process. For right now, I'm just choosing one arbitrarily as a test case.
 
 HTids_toprocess = ['pst.000004048572','pst.000004178651','pst.000004287971','pst.000004929574','pst.000004703440']
 
+def getpairtreeroot():
+    '''
+    Returns the root folder of the pairtree structure.  The path dictionary is
+    only read the first time this is called.  If it doesn't name a pairtreeroot,
+    we fall back on a 'collection' folder alongside the collator directory.
+    '''
+    global pathdictionary
+
+    if pathdictionary is None:
+        pathdictionary = filekeeping.loadpathdictionary()
+
+    if "pairtreeroot" in pathdictionary:
+        return pathdictionary["pairtreeroot"]
+    else:
+        ##   Hard-coding root path for development purposes, change this to your local root folder before running!
+        ##    pairtree_rootpath = input("What is the path to the root folder for your pairtree structure? ")
+        collator_directory = os.getcwd()
+
+        return collator_directory[:-8] + 'collection/'
+
 # This is a special alphabet to be used in the bigram index.
 alphabet = ['$', 'a', 'b', 'c', 'd', 'e', 'f', 'g', 'h', 'i', 'j', 'k',
 'l', 'm', 'n', 'o', 'p', 'q', 'r', 's', 't', 'u', 'v', 'w', 'x', 'y',
@@ -71,148 +98,475 @@ def dicecoefficient(firstset, secondset):
         return 0
     else:
         return (2 * len(firstset.intersection(secondset))) / (len(firstset) + len(secondset))
-        
-def segment(headersequence,pagelist,pageheaders):
+
+# The same running headers ("chapter i", "introduction", "preface") turn up in
+# volume after volume, so header bigram sets are memoized in a bounded LRU
+# cache.  The cache belongs to the process, not to a volume, so a long-running
+# worker keeps reusing it from one collate() call to the next.  Only bigram
+# sets are cached: the 'index' and 'numpy' backends work out Dice scores from
+# counts they already have, which is cheaper than looking them up.  Use
+# configurecache() to resize (or, with size 0, disable) it and cachestats()
+# to see whether it is paying off.
+
+def configurecache(bigramsize=8192):
+    '''
+    Replaces the header bigram cache with an empty one holding at most
+    bigramsize entries.  Hit and miss counts start over from zero.
+    '''
+    global bigramcache
+
+    bigramcache = functools.lru_cache(maxsize = bigramsize)(lambda header: frozenset(getbigrams(header)))
+
+def cachestats():
+    '''
+    Returns the hit and miss counters, current size and maximum size of the
+    cache, as a dictionary of dictionaries keyed 'bigrams'.
+    '''
+    return {'bigrams': bigramcache.cache_info()._asdict()}
+
+def headerbigrams(header):
+    '''The bigram set of a header, as a frozenset, from the cache if possible.'''
+    return bigramcache(header)
+
+configurecache()
+
+def bigrambitsets(headers):
+    '''
+    Encodes each header's bigram set as a row of bits, packed into an array of
+    uint64 words, one row per header.  Bigrams of two letters from the alphabet
+    get a fixed position (27 x 27 = 729 of them); any other bigram that turns up
+    in these headers (digits, punctuation, accented letters) gets a position
+    after those, so the encoding is exact.  Returns the packed array and an
+    array of the sizes of the bigram sets.  Requires numpy.
+    '''
+    import numpy
+
+    letterpositions = {letter: idx for idx, letter in enumerate(alphabet)}
+    width = len(alphabet) * len(alphabet)
+    extrapositions = {}
+
+    rows = []
+    for header in headers:
+        positions = []
+        for bigram in headerbigrams(header):
+            first = letterpositions.get(bigram[0])
+            second = letterpositions.get(bigram[1])
+            if first is not None and second is not None:
+                positions.append(first * len(alphabet) + second)
+            else:
+                if bigram not in extrapositions:
+                    extrapositions[bigram] = width + len(extrapositions)
+                positions.append(extrapositions[bigram])
+        rows.append(positions)
+
+    words = (width + len(extrapositions) + 63) // 64
+    flags = numpy.zeros((len(rows), words * 64), dtype = numpy.uint8)
+    sizes = numpy.zeros(len(rows), dtype = numpy.int64)
+    for idx, positions in enumerate(rows):
+        flags[idx, positions] = 1
+        sizes[idx] = len(positions)
+
+    packed = numpy.packbits(flags, axis = 1, bitorder = 'little')
+    return packed.view('<u8'), sizes
+
+def popcount(words):
+    '''Counts the set bits in each row of a 2-d array of uint64 words.'''
+    import numpy
+
+    if hasattr(numpy, 'bitwise_count'):
+        return numpy.bitwise_count(words).sum(axis = 1, dtype = numpy.int64)
+
+    # Older versions of numpy have no popcount, so look bytes up in a table.
+    table = numpy.array([bin(byte).count('1') for byte in range(256)], dtype = numpy.int64)
+    return table[words.view(numpy.uint8)].sum(axis = 1)
+
+def bitsetdice(bitset, size, bitsets, sizes):
+    '''
+    The Dice coefficient of one bigram bitset (with size set bits) against every
+    row of bitsets at once.  Gives the same values dicecoefficient() would on the
+    corresponding sets.
+    '''
+    overlaps = popcount(bitsets & bitset)
+    return (2 * overlaps) / (size + sizes)
+
+def minimumoverlap(setsize):
+    '''
+    Returns the smallest number of bigrams a set of setsize bigrams must share
+    with another set for their Dice coefficient to exceed dice_cutoff, whatever
+    the size of the other set.  The bound is loosest when the other set is the
+    smallest one that could still qualify, so we find that size first.
+    '''
+    for othersize in range(1, setsize + 1):
+        if (2 * othersize) / (setsize + othersize) > dice_cutoff:
+            for overlap in range(1, othersize + 1):
+                if (2 * overlap) / (setsize + othersize) > dice_cutoff:
+                    return overlap
+
+    return setsize + 1
+
+def clusterheaders(headersequence,backend='index'):
+    '''
+    Accepts a list of (header, frequency) tuples, ordered by frequency, and
+    returns headerdict: a dictionary of translation rules mapping actually-occurring
+    headers to normalized header categories. Each header category is represented
+    as a tuple containing 0) the normalized header and 1) an integer code for it.
+
+    We use a bigram-indexing strategy to figure out whether each new header is
+    "the same as" one already in the headerdict. If so, add a translation rule to
+    the headerdict. Otherwise, add it to the headerdict as itself. When a header
+    is "the same as" more than one category, the last category created wins.
+
+    The 'index' backend only scores categories that share enough bigrams with the
+    header for the Dice coefficient to have any chance of clearing dice_cutoff.
+    The 'numpy' backend encodes bigram sets as bitsets and scores a header against
+    every category in one vectorized operation; it needs numpy installed.  The
+    'scan' backend compares every header against every category, one pair at a
+    time, and is kept as the reference the others are checked against.
+    '''
+
+    # valid_headers stores normalized header names; position in the list is the
+    # integer code for the category. Bigram sets come from the cache, since the
+    # same headers recur across volumes.
+
+    headerdict = {}
+    valid_headers = []
+
+    if backend == 'scan':
+        for header in headersequence:
+            matched = False
+
+            for idx, possible_match in enumerate(valid_headers):
+                dice = dicecoefficient(headerbigrams(header[0]), headerbigrams(possible_match))
+
+                if dice > dice_cutoff:
+                    headerdict[header[0]] = (possible_match, idx)
+                    matched = True
+
+            if matched == False:
+                headerdict[header[0]] = (header[0], len(valid_headers))
+                valid_headers.append(header[0])
+                # We use the current length of valid_headers to
+                # establish an integer code for this header category.
+
+        return headerdict
+
+    elif backend == 'numpy':
+        bitsets, sizes = bigrambitsets([header[0] for header in headersequence])
+
+        # Category bitsets are copied into the first rows of this array as the
+        # categories are created, so there's one to score against for each.
+
+        categories = bitsets.copy()
+        categorysizes = sizes.copy()
+
+        for idx, header in enumerate(headersequence):
+            count = len(valid_headers)
+            best = -1
+            if count > 0:
+                dice = bitsetdice(bitsets[idx], sizes[idx], categories[:count], categorysizes[:count])
+                matches = (dice > dice_cutoff).nonzero()[0]
+                if len(matches) > 0:
+                    best = int(matches[-1])
+
+            if best >= 0:
+                headerdict[header[0]] = (valid_headers[best], best)
+            else:
+                headerdict[header[0]] = (header[0], count)
+                valid_headers.append(header[0])
+                categories[count] = bitsets[idx]
+                categorysizes[count] = sizes[idx]
+
+        return headerdict
+
+    elif backend != 'index':
+        raise ValueError("Unknown clustering backend: " + str(backend))
+
+    # The inverted index maps each bigram to the codes of the categories that
+    # contain it, so counting a header's hits on the postings gives the size of
+    # its intersection with every category it shares a bigram with. Dice can't
+    # exceed 2 * min(a, b) / (a + b) for sets of sizes a and b, which sets a floor
+    # on the overlap any category could clear the cutoff with (see
+    # minimumoverlap); only categories above that floor get scored.
+
+    index = {}
+    sizes = []
+
+    for header in headersequence:
+        bigramdex = headerbigrams(header[0])
+        a = len(bigramdex)
+        floor = minimumoverlap(a)
+
+        hits = Counter(chain.from_iterable([index[bigram] for bigram in bigramdex if bigram in index]))
+        candidates = [idx for idx, overlap in hits.items() if overlap >= floor]
+
+        best = -1
+        for idx in sorted(candidates, reverse = True):
+            if (2 * hits[idx]) / (a + sizes[idx]) > dice_cutoff:
+                best = idx
+                break
+
+        if best >= 0:
+            headerdict[header[0]] = (valid_headers[best], best)
+        else:
+            code = len(valid_headers)
+            headerdict[header[0]] = (header[0], code)
+            valid_headers.append(header[0])
+            sizes.append(a)
+            for bigram in bigramdex:
+                index.setdefault(bigram, []).append(code)
+
+    return headerdict
+
+def pagewordcount(page):
+    '''
+    Returns the number of words on a page (a list of lines).  Lines are joined
+    with a space, so a line without a trailing newline can't run its last word
+    into the first word of the next line.
+    '''
+    return len(' '.join(page).split())
+
+def countwords(pagelist):
+    '''Returns an array with the number of words on each page.'''
+    return array('q', [pagewordcount(page) for page in pagelist])
+
+def wordprefixes(pagewords):
+    '''
+    Turns per-page word counts into an array of running totals, starting with
+    0, so the words on pages start through end are wordprefix[end + 1] -
+    wordprefix[start].
+    '''
+    return array('q', accumulate(pagewords, initial = 0))
+
+def repairsections(sectioncodes):
+    '''
+    Corrects, in place, the pages segment() couldn't assign to a section (coded
+    999).  A page at the very start of the volume takes the first valid code in
+    the volume; a page at the very end takes the code of the page before it; any
+    other invalid page takes the last valid code before it (or 0, if there is
+    none yet).  Returns sectioncodes.
+
+    This used to be worked out by counting forward from each invalid page to
+    the next valid one and comparing that with the distance back to the last
+    corrected page. But the last corrected page is always the previous page,
+    one step back, while the next valid page is at least two steps ahead (the
+    step onto the invalid page counts), so the page behind always won. Filling
+    forward gives the same codes in one pass instead of a rescan per page.
+    '''
+    if len(sectioncodes) == 0:
+        return sectioncodes
+
+    ## First pass: find the first valid code, which is the fix for page 0.
+    ## A repaired first page doesn't count as valid for the pages after it.
+
+    if sectioncodes[0] == 999:
+        lastsection = 0
+        for replace in sectioncodes:
+            if replace != 999:
+                sectioncodes[0] = replace
+                break
+    else:
+        lastsection = sectioncodes[0]
+
+    ## Second pass: carry the last valid code forward over invalid pages.
+
+    for idx in range(1, len(sectioncodes)):
+        page = sectioncodes[idx]
+        if page != 999:
+            lastsection = page
+        elif idx == len(sectioncodes) - 1:
+            sectioncodes[idx] = sectioncodes[idx - 1]
+        else:
+            sectioncodes[idx] = lastsection
+
+    return sectioncodes
+
+def countpairs(headercodes,backend='index'):
+    '''
+    Counts how often each pair of header codes turns up on neighbouring pages,
+    in either order, and returns a dictionary mapping each pair to its count.
+    A pair is keyed in the order it first turns up in, and the pairs come in
+    that order too.
+
+    Each page counts the pair it makes with the page after it and the pair it
+    makes with the page before it, so most pairs of neighbours count twice.
+    But when the pages on either side of a page have the same header, those
+    two pairs are the same (reversed), and the page counts it just once: so
+    the pair of pages j, j + 1 counts once if page j + 2 has the same header
+    as page j, and twice otherwise.
+
+    Each pair of neighbours is looked up by a single integer key, the smaller
+    code times the number of codes plus the larger, so a pair and its reverse
+    share a key.  With the 'numpy' backend (see clusterheaders), the keys and
+    weights are worked out for every pair of neighbours at once and summed
+    with bincount; the other backends count them one at a time.  Either way
+    the result is the same.
+
+    The vectorized count is only used when the 'numpy' backend is asked for,
+    even if numpy is installed.  It is about four times as fast, but counting
+    one at a time takes under 5 ms for a 10,000-page volume, while importing
+    numpy takes on the order of 100 ms, so for most runs numpy would cost
+    more than it saves.
+    '''
+    if backend == 'numpy':
+        return countpairsnumpy(headercodes)
+
+    width = max(headercodes, default = 0) + 1
+    last = len(headercodes) - 1
+
+    counts = {}
+    firstpairs = {}
+
+    for idx in range(last):
+        first = headercodes[idx]
+        second = headercodes[idx + 1]
+        if first <= second:
+            key = first * width + second
+        else:
+            key = second * width + first
+        if idx + 2 <= last and headercodes[idx + 2] == first:
+            weight = 1
+        else:
+            weight = 2
+        if key in counts:
+            counts[key] += weight
+        else:
+            counts[key] = weight
+            firstpairs[key] = (first, second)
+
+    return {firstpairs[key]: count for key, count in counts.items()}
+
+def countpairsnumpy(headercodes):
+    '''countpairs(), vectorized.  Requires numpy.'''
+    import numpy
+
+    codes = numpy.asarray(headercodes, dtype = numpy.int64)
+    if len(codes) < 2:
+        return {}
+
+    first = codes[:-1]
+    second = codes[1:]
+    width = int(codes.max()) + 1
+    keys = numpy.minimum(first, second) * width + numpy.maximum(first, second)
+
+    weights = numpy.full(len(keys), 2, dtype = numpy.int64)
+    weights[:-1] -= codes[2:] == codes[:-2]
+
+    # unique() sorts the keys; return_index gives where each first turned
+    # up, which is the order (and orientation) countpairs() keys them in.
+
+    uniquekeys, firstseen, inverse = numpy.unique(keys, return_index = True, return_inverse = True)
+    counts = numpy.bincount(inverse.ravel(), weights = weights, minlength = len(uniquekeys))
+
+    order = numpy.argsort(firstseen)
+    return {(int(first[idx]), int(second[idx])): int(count)
+            for idx, count in zip(firstseen[order], counts[order])}
+
+# Instrumentation.  collate() and the functions under it take an optional
+# stats dictionary.  When one is passed, they add the seconds spent in each
+# stage to stats['seconds'] and record a few counts (pages, distinct headers,
+# header clusters, valid header pairs, sections).  When it's None, as it is
+# by default, all that's skipped, at the cost of one comparison per stage.
+
+def stagetime(stats,stage,started):
+    '''Adds the time since started to stage's total in stats['seconds'], and
+    returns the time now, from which to time the next stage.'''
+    now = perf_counter()
+    seconds = stats.setdefault('seconds', {})
+    seconds[stage] = seconds.get(stage, 0) + now - started
+    return now
+
+def segment(headersequence,wordprefix,pageheaders,backend='index',stats=None):
     '''
     This function accepts a list of header known header strings, ordered by frequency,
-    the full text of the document in question, and a list of page header strings in
-    the order they appear in the document.  After employing a bigram indexing stretegy
+    running totals of the words in the document (see wordprefixes), and a list of
+    page header strings in the order they appear in the document.  After employing a bigram indexing stretegy
     to remove OCR errors, divides up the text into sections by identifying repeated
     pairs of headers (any pair that appears more than 4 times is a section).  Also
     removes errors in division by merging any continguous group of pages that share the
     same section number but have less than 2,000 words into the next section.
+    The backend used to match headers and count pairs of them can be chosen; see
+    clusterheaders() and countpairs().
+    The section codes come back as an array('q'), one code per page, as do the
+    header codes they're worked out from.
+    If a stats dictionary is passed, the time spent clustering headers,
+    counting pairs and assigning sections is added to it (see stagetime).
     '''
+    if stats is not None:
+        started = perf_counter()
     
-    # headerdict holds a dictionary of translation rules mapping actually-occurring
-    # headers to normalized header categories. Each header category is represented
-    # as a tuple containing 0) the normalized header and 1) an integer code for it.
-    #
-    # We use a bigram-indexing strategy to figure out whether
-    # each new header is "the same as" one already in the headerdict. If so, add a
-    # translation rule to the headerdict. Otherwise, add it to the headerdict
-    # as itself.
-    #
-    # valid_headers stores normalized header names, paired as tuples
-    # with the bigram index for each so they can be checked as possible
-    # matches.
-    
-    headerdict = {}
-    valid_headers = []
-    
-    for idx,header in enumerate(headersequence):
-        bigramdex = getbigrams(header[0])
-        matched = False
+    headerdict = clusterheaders(headersequence,backend)
 
-        for idx, entrytuple in enumerate(valid_headers):
-            possible_match, match_bigramdex  = entrytuple
-            dice = dicecoefficient(bigramdex, match_bigramdex)
-            
-            if dice > dice_cutoff:
-                headerdict[header[0]] = (possible_match, idx)
-                matched = True
-
-        if matched == False:
-            entrytuple = header[0], bigramdex
-            headerdict[header[0]] = (header[0], len(valid_headers))
-            valid_headers.append(entrytuple)
-            # We use the current length of valid_headers to
-            # establish an integer code for this header category.
+    if stats is not None:
+        started = stagetime(stats,'cluster',started)
+        stats['clusters'] = len(set(code for normalized, code in headerdict.values()))
 
     # Now go back through the original list of pageheaders and use
-    # headerdict to translate it into a list of header codes.
+    # headerdict to translate it into an array of header codes.  Per-page
+    # state (header codes, section codes, word counts) is kept in integer
+    # arrays rather than lists, which matters on volumes of thousands of pages.
     
-    headercodes = []
-    for header in pageheaders:
-        normalized, header_code = headerdict[header]
-        headercodes.append(header_code)
+    headercodes = array('q', [headerdict[header][1] for header in pageheaders])
 
-    ## Once the list of header codes has been established, run through the list
-    ## and count the number of pairings (both before and after)
-    
-    paircounts = {}
-    
-    for idx, code in enumerate(headercodes):
-        
-        if idx < len(headercodes) - 1:
-            after = code, headercodes[idx + 1]
-            if after in paircounts:
-                paircounts[after] += 1
-            elif (after[1],after[0]) in paircounts:
-                paircounts[(after[1],after[0])] += 1
-            else:
-                paircounts[after] = 1
+    ## Once the array of header codes has been established, count the number of
+    ## pairings (both before and after).  See countpairs.
+
+    paircounts = countpairs(headercodes,backend)
 
-    ## First conditional in this set checks to make sure the before/after pairs
-    ## don't match only if the loop isn't at either end of the header list
-                
-        if idx > 0:
-            before = headercodes[idx - 1], code
-            if idx < len(headercodes) -1 and before == (after[1],after[0]):  
-                continue
-            elif before in paircounts:
-                paircounts[before] += 1
-            elif (before[1],before[0]) in paircounts:
-                paircounts[(before[1],before[0])] += 1
-            else:
-                paircounts[before] = 1
-                
     validpairs = {}
     
     for pair in paircounts:
         if paircounts[pair] >= 4:
             validpairs[pair] = paircounts[pair]
+
+    if stats is not None:
+        started = stagetime(stats,'pairs',started)
+        stats['validpairs'] = len(validpairs)
             
     ## Go back through the list and assign section codes to pairs of headers. The dicionary
     ## sectiondict links header pairs (stored as tuples) to section codes.  The
-    ## list will be the same length as pageheaders list and indicate which section
+    ## array will be the same length as pageheaders and indicate which section
     ## each page belongs to.  Invalid sections assigned 999 as code for correction later.
     ## Checks before and after pairings, then resolves conflict by auto-assigning to
     ## more the common of the two.  The sectionlist allows for reverse look-up (for use
     ## in metadata generation).
     
-    sectioncodes = []
     sectiondict = {}
     sectionlist = []
-    
-    ## If a page's header pairing is valid (appears more than 4 times), give it a section
-    ## code. If not, assigned 999 as an error code.  If it's the first or last, assign -1
-    ## so that conflict resolution checks will automatically give it the same code as the page
+
+    ## Each pair of neighbouring pages gets the code of its header pairing if that's
+    ## valid (appears more than 4 times), or 999, as an error code.  Codes are handed
+    ## out in the order the valid pairings first turn up.  A page looks at the pair
+    ## it makes with the page before and the one it makes with the page after; the
+    ## first and last pages are missing one of those, which counts as -1, so that
+    ## conflict resolution checks will automatically give them the same code as the
     ## second or penultimate page.
-    
-    for idx, code in enumerate(headercodes):
+
+    pairsections = array('q', [0]) * max(len(headercodes) - 1, 0)
+
+    for idx in range(len(headercodes) - 1):
+        s = headercodes[idx], headercodes[idx + 1]
+        r = (s[1],s[0])
+        if s in validpairs:
+            pass
+        elif r in validpairs:
+            s = r
+        else:
+            pairsections[idx] = 999
+            continue
+        if s not in sectiondict:
+            sectiondict[s] = len(sectiondict)
+            sectionlist.append(s)
+        pairsections[idx] = sectiondict[s]
+
+    sectioncodes = array('q', [0]) * len(headercodes)
+
+    for idx in range(len(headercodes)):
         if idx < len(headercodes) - 1:
-            s = code, headercodes[idx + 1]
-            r = (s[1],s[0])
-            if s in validpairs:
-                if s not in sectiondict:
-                    sectiondict[s] = len(sectiondict)
-                    sectionlist.append(s)
-                after = sectiondict[s]
-            elif r in validpairs:
-                if r not in sectiondict:
-                    sectiondict[r] = len(sectiondict)
-                    sectionlist.append(r)
-                after = sectiondict[r]
-            else:
-                after = 999
+            after = pairsections[idx]
         else:
             after = -1
-                  
         if idx > 0:
-            s = headercodes[idx - 1], code
-            r = (s[1],s[0])
-            if s in validpairs:
-                if s not in sectiondict:
-                    sectiondict[s] = len(sectiondict)
-                    sectionlist.append[s]
-                before = sectiondict[s]
-            elif (r) in validpairs:
-                if (r) not in sectiondict:
-                    sectiondict[r] = len(sectiondict)
-                    sectionlist.append(r)
-                before = sectiondict[r]
-            else:
-                before = 999
+            before = pairsections[idx - 1]
         else:
             before = -1
 
@@ -228,107 +582,61 @@ def segment(headersequence,pagelist,pageheaders):
         else:
             add = after
             
-        sectioncodes.append(add)
-
-    ## This loop examines the just created section code list to make corrections
-    ## where invalid sections appear.  Start with 0 because first section should
-    ## be zero.  First, check if beginning of index or end of index (since those
-    ## are easy to fix).  Otherwise, count forward to for the next non-error code.
-    ## Then compare distance between last known non-error and the next non-error.
-    ## When correcting, update the last known section ID and last known index so
-    ## that there's no need to loop bakwards to make corrections.
-    
-    lastsection = 0
-    lastknowndex = 0
-    
-    for idx,page in enumerate(sectioncodes):
-        if page != 999:
-            lastsection = page
-            lastknowndex = idx
-        elif idx == 0:
-            for replace in sectioncodes:
-                if replace != 999:
-                    sectioncodes[idx] = replace
-                    lastknowndex = idx
-                    break
-        elif idx == len(sectioncodes) - 1:
-            sectioncodes[idx] = sectioncodes[idx - 1]
-        else:
-            count = 0
-            for replace in sectioncodes[idx:]:
-                count += 1
-                if replace != 999:
-                    break
-            if (idx - lastknowndex) > count:
-                sectioncodes[idx] = sectioncodes[idx + count]
-                lastsection = page
-                lastknowndex = idx
-            elif (idx - lastknowndex) < count:
-                sectioncodes[idx] = lastsection
-                lastknowndex = idx
-            elif paircounts[sectionlist[sectioncodes[idx - lastknowndex]]] > paircounts[sectionlist[sectioncounts[idx + count]]]:
-                sectioncodes[idx] = lastsection
-                lastknowndex = idx
-            else:
-                sectioncodes[idx] = sectioncodes[idx + count]
-                lastsection = page
-                lastknowndex = idx
+        sectioncodes[idx] = add
+
+    ## Fill in the pages whose header pairing was invalid (coded 999).
+
+    repairsections(sectioncodes)
 
     ## These loops count the words in each section to establish which are too short
     ## and then folds those with less than 2,000 words into the closest neighboring
     ## section (that has more than 2,000 words)
-    
-    wordcount = list()
+    ##
+    ## Figure out continguous sections and count the worlds in them.  The words
+    ## in pages start..end are wordprefix[end + 1] - wordprefix[start].  Each run
+    ## of pages is kept as its first page, last page and word count, in three
+    ## parallel arrays.  (If the first page's code isn't 0, an empty run from
+    ## page 0 to page -1 comes first; it has no pages to recode.)
+
+    runstarts = array('q')
+    runends = array('q')
+    runwords = array('q')
     checking = 0
     start = 0
-    sectcount = 0
-    
-    ## Figure out continguous sections and count the worlds in them.
     
-    for idx,page in enumerate(pagelist):
+    for idx in range(len(sectioncodes)):
         if checking != sectioncodes[idx]:
-            wordcount.append((start,idx-1,sectcount))
+            runstarts.append(start)
+            runends.append(idx - 1)
+            runwords.append(wordprefix[idx] - wordprefix[start])
             start = idx
             checking = sectioncodes[idx]
-            sectcount = 0
-        for line in page:
-            words = line.split()
-            sectcount += len(words)
-        if idx == len(pagelist) - 1:
-            wordcount.append((start,idx,sectcount))
-
-    ## Put section ranges of those with less than 2,000 into a set
-    ## as tuples for if in checks during correction.
-    
-    removes = set()
-    
-    for idx,section in enumerate(wordcount):
-        if section[2] < 2000:
-            removes.add((section[0],section[1]))
-
-    ## Look at the word counts for each contiguous section.  If
-    ## it has been highlighted for removal, then give it the next
-    ## section's code.  If the last section needs to be removed,
-    ## give it the same code as the previous one.
+        if idx == len(sectioncodes) - 1:
+            runstarts.append(start)
+            runends.append(idx)
+            runwords.append(wordprefix[idx + 1] - wordprefix[start])
+
+    ## Look at the word counts for each contiguous section.  If it has less
+    ## than 2,000 words, then give it the next long enough section's code.
+    ## If there isn't one, give it the same code as the previous one.
     
-    for idx,section in enumerate(wordcount):
-        if (section[0],section[1]) in removes:
-            pagecodes = range(section[0],section[1]+1)
+    for idx in range(len(runstarts)):
+        if runwords[idx] < 2000:
             newcode = -1
-            if idx < len(wordcount) - 1:
-                for x in wordcount[idx:]:
-                    if (x[0],x[1]) not in removes:
-                        newcode = sectioncodes[x[0]]
+            if idx < len(runstarts) - 1:
+                for x in range(idx, len(runstarts)):
+                    if runwords[x] >= 2000:
+                        newcode = sectioncodes[runstarts[x]]
                         lastvalidcode = newcode
                         break
             if newcode == -1:
                 newcode = lastvalidcode
 
-            for x in pagecodes:
+            for x in range(runstarts[idx], runends[idx] + 1):
                 sectioncodes[x] = newcode
             
         else:
-            lastvalidcode = sectioncodes[section[0]]
+            lastvalidcode = sectioncodes[runstarts[idx]]
 
     ## This could probably be compressed but I don't want to fix what
     ## is working.  Create a set of headerdict's values, then extracts
@@ -351,6 +659,9 @@ def segment(headersequence,pagelist,pageheaders):
             metadata[i] = headerkey[section[1]]
         else:
             metadata[i] = headerkey[section[0]]
+
+    if stats is not None:
+        stagetime(stats,'sections',started)
             
     ## Return sectioncodes so div's can be generated using metadata.  Return
     ## headerdict so pre-normalized section headers can be identified and removed
@@ -358,7 +669,7 @@ def segment(headersequence,pagelist,pageheaders):
             
     return sectioncodes, headerdict, metadata
 
-def correctsequence(sectioncodes,metadata,pagelist):
+def correctsequence(sectioncodes,metadata,wordprefix):
     '''
     After sections have been determined, the codes need to be adjusted
     so that they appear in the correct sequence.  IE, [2,3,1,0,4,7,8]
@@ -367,7 +678,8 @@ def correctsequence(sectioncodes,metadata,pagelist):
     a metadata table with section names and word counts.  It has been separated
     from the segmentation function for debug/developmental purposes, but the
     two are meant to be run together on texts to completely prepare them for
-    the final collation loop.
+    the final collation loop.  sectioncodes (an array('q'), from segment())
+    is renumbered in place and returned.
     '''
     
     fixtable = []
@@ -399,10 +711,14 @@ def correctsequence(sectioncodes,metadata,pagelist):
     for code in fixtable:
         fixedmeta.append([metadata[code[0]],0,(code[1],code[2])])
     
-    for idx,page in enumerate(pagelist):
-        for line in page:
-            words = line.split()
-            fixedmeta[sectioncodes[idx]][1] += len(words)
+    ## Pages with the same corrected code are contiguous, so each run's word
+    ## count comes straight from the running totals.
+
+    start = 0
+    for idx in range(1, len(sectioncodes) + 1):
+        if idx == len(sectioncodes) or sectioncodes[idx] != sectioncodes[start]:
+            fixedmeta[sectioncodes[start]][1] += wordprefix[idx] - wordprefix[start]
+            start = idx
             
     ## The metadata is supposed to be a tuple, so better correct that
     ## before it gets returned!
@@ -412,33 +728,46 @@ def correctsequence(sectioncodes,metadata,pagelist):
     
     return sectioncodes, fixedmeta
 
-def collate(pagelist):
+def pageheader(page):
     '''
-    Accepts a list of pages (each of which is a list of lines) and reads through them,
-    discovering headers (if present) and guessing section divisions based on pairing
-    patterns.  Returns the prepared text, ready for writing to disk (or analysis by
-    functions from other libraries).
+    Returns the running header of a page (a list of lines), normalized for
+    matching, or "" if the page doesn't seem to have one.
     '''
-    pageheaders = []
-    for page in pagelist:
-        header = ""
-        for line in page:
-            # Current strategy: the running header is the first line
-            # with more than four characters in it.
-            
-            if len(line) < 5 or line.isdigit():
-                continue
-            else:
-                header = line.strip('1234567890. ,"\t\n')
-                header = header.lower()
-                # Here it would also be nice to have a function
-                # that strips roman numerals, when they constitute
-                # a separate word, without automatically stripping
-                # all i's and v's from the header.
-                
-                break
+    header = ""
+    for line in page:
+        # Current strategy: the running header is the first line
+        # with more than four characters in it.
+        
+        if len(line) < 5 or line.isdigit():
+            continue
+        else:
+            header = line.strip('1234567890. ,"\t\n')
+            header = header.lower()
+            # Here it would also be nice to have a function
+            # that strips roman numerals, when they constitute
+            # a separate word, without automatically stripping
+            # all i's and v's from the header.
             
-        pageheaders.append(header)
+            break
+
+    return header
+
+def plancollation(pageheaders,pagewords,backend='index',stats=None):
+    '''
+    Works out how a volume should be collated from nothing but the header and
+    the word count of each page, so the text itself needn't be held in memory
+    while this runs.  Returns a tuple of
+        divplace:   page where each <div> opens -> (page where it closes, section
+                    name, section word count, section #)
+        closeplace: page where each <div> closes -> page where it opened
+        remove:     every form of the running headers to strip from the pages
+    which collatepage() then applies to the pages one at a time.  stats is as
+    for collate().
+    '''
+    if stats is not None:
+        started = perf_counter()
+
+    wordprefix = wordprefixes(pagewords)
 
     # Now we construct a dictionary where headers are associated with
     # the number of times they occur in pageheaders. Misspellings,
@@ -460,6 +789,10 @@ def collate(pagelist):
     frequencies = [x[1] for x in headersequence]
     avg_freq = sum(frequencies) / len(frequencies)
 
+    if stats is not None:
+        stats['pages'] = len(pageheaders)
+        stats['headers'] = len(headerdict)
+
     ## SECTION ASSIGNMENT / SEGMENTATION & CORRECTION
     ## Assign header codes, divide into sections, and count words in each section
     ## These two functions can be skipped for books that don't seem to have running
@@ -467,10 +800,14 @@ def collate(pagelist):
     ## for the collation loop.
 
     if avg_freq > 2.5:
-        sectioncodes, headerdict, metadata = segment(headersequence,pagelist,pageheaders)
-        sectioncodes,metadata = correctsequence(sectioncodes, metadata,pagelist)
-    else:
-        sectioncodes = [0] * len(pageheaders)
+        if stats is not None:
+            stagetime(stats,'plan',started)
+        sectioncodes, headerdict, metadata = segment(headersequence,wordprefix,pageheaders,backend,stats)
+        if stats is not None:
+            started = perf_counter()
+        sectioncodes,metadata = correctsequence(sectioncodes, metadata,wordprefix)
+        if stats is not None:
+            started = stagetime(stats,'correct',started)
         
     
     ## Now that everything has been segmented, and the metadata table is finished,
@@ -487,12 +824,17 @@ def collate(pagelist):
         for idx,section in enumerate(metadata):
             divplace[section[2][0]] = (section[2][1],section[0],section[1],idx)
     else:
-        wc = 0
-        for page in pagelist:
-            for line in page:
-                words = line.split()
-                wc += len(words)
+        wc = wordprefix[-1]
         divplace[0] = (len(pageheaders) - 1,'Fulltext',wc,0)
+
+    ## The reverse lookup, for the pages that get a closing </div>.  A <div> that
+    ## would open past the last page is never placed, so it doesn't close either.
+
+    closeplace = {}
+
+    for opening, placement in divplace.items():
+        if opening < len(pageheaders):
+            closeplace[placement[0]] = opening
         
     ## Second, use the headerdict to create a set of all different forms of
     ## the valid headers to use when remove running headers from all pages.
@@ -512,76 +854,1132 @@ def collate(pagelist):
             if value[0] in remove:
                 remove.add(key)    
 
+    if stats is not None:
+        stagetime(stats,'plan',started)
+        stats['sections'] = len(closeplace)
+
+    return divplace, closeplace, remove
+
+def pagelayout(idx,page,plan):
+    '''
+    Works out how a collation plan (from plancollation) applies to page number
+    idx, a list of lines, without touching the page.  Returns a tuple of
+        prefix: a list of the lines that go before the page's own (the opening
+                <div>, if any)
+        start, end: the page's own lines that are kept, page[start:end], which
+                skips any page number and running header at the top, and the
+                last line, which is cleaned up and kept in suffix, if at all
+        suffix: a list of the lines that go after them (the last line, the
+                <pb>, and any </div>)
+    so the collated page is prefix + page[start:end] + suffix.  Lines are never
+    deleted from or inserted at the front of a list, which shifts the rest.
+    '''
+
     ## COLLATION LOOP        
-    ## Now go through the text, page by page.  If the page number matches that
-    ## one of the keys in the division dictionary, then put an opening <div>
-    ## with the relevant meta-data at the top of the page.  Then skip to
-    ## the page that marks the last of that same section and put a closing
-    ## </div> at the bottom.  For all pages, check to make the last line is
-    ## non-empty (and if so, remove it) then append <pb> on it's own line.
+    ## If the page number matches that one of the keys in the division
+    ## dictionary, then put an opening <div> with the relevant meta-data at the
+    ## top of the page.  If it's the page that marks the last of a section, put
+    ## a closing </div> at the bottom.  For all pages, check to make the last
+    ## line is non-empty (and if so, remove it) then append <pb> on it's own line.
     ## Also, check to see if the page's first line (without numbers and 
     ## punctation) matches one of the known forms of a valid header.  If so,
-    ## then delete that line.
+    ## then skip that line.
     ##
     ## NOTE: The header removal check first checks to see if a line is only
     ## numbers (ie, OCR placed the page number on a line above the header).
-    ## If so, remove line with page number and check 2nd line for header.
+    ## If so, skip line with page number and check 2nd line for header.
     ## Without this check, some running headers will not be removed.
+    ##
+    ## A section that closes on a later page than it opens has its </div> put
+    ## on the closing page before that page gets its <pb>, which ends up after
+    ## the </div>.  When a section opens and closes on the same page, the </div>
+    ## comes last.
+    ##
+    ## The page is read as page[:end], then the lines in tail: the
+    ## cleaned-up last line (if any is left) or the early </div>, then the <pb>.
+
+    divplace, closeplace, remove = plan
+
+    end = len(page)
+    tail = []
+    blank = end == 0
+
+    if idx in closeplace and closeplace[idx] < idx:
+        tail.append("</div>\n")
+        blank = False
+    elif end > 0:
+        end -= 1
+        last = page[end].strip()
+        if len(last) > 0:
+            tail.append(last + "\n")
+
+    start = 0
+
+    if not blank:
+        tail.append("<pb>\n")
+        header = page[0] if end > 0 else tail[0]
+        header = header.rstrip('\n')
+        if header.isnumeric():
+            start = 1
+            header = page[1] if end > 1 else tail[1 - end]
+        header = header.strip('0123456789.,!@#$%^&*()[]<> \n')
+        header = header.lower()
+
+        if header in remove:
+            start += 1
+
+    if idx in divplace:
+        prefix = ['<div id="{1}" code="{3}" wordcount="{2}">\n'.format(*divplace[idx])]
+    else:
+        prefix = []
+
+    suffix = tail[max(start - end, 0):]
+    if idx in closeplace and closeplace[idx] >= idx:
+        suffix.append("</div>\n")
+
+    return prefix, start, end, suffix
+
+def collatepage(idx,page,plan):
+    '''
+    Applies a collation plan (from plancollation) to page number idx, a list
+    of lines, and returns the collated lines as a new list (see pagelayout).
+    The page passed in is left as it was.
+    '''
+    prefix, start, end, suffix = pagelayout(idx,page,plan)
+    return prefix + page[start:end] + suffix
+
+def collate(pagelist,backend='index',pagewords=None,stats=None):
+    '''
+    Accepts a list of pages (each of which is a list of lines) and reads through them,
+    discovering headers (if present) and guessing section divisions based on pairing
+    patterns.  Returns the prepared text as a new list of pages, ready for writing to
+    disk (or analysis by functions from other libraries); the pages passed in are
+    left as they were, so they can be used again.  backend chooses how running headers are
+    matched (see clusterheaders); it doesn't change the result.  If the caller
+    already has the word count of each page (see countwords), it can pass them as
+    pagewords; otherwise they are counted here, once, before anything else.
+
+    To see where the time goes, pass a dictionary as stats.  The seconds spent
+    in each stage -- counting words, finding headers, clustering them, counting
+    header pairs, assigning and correcting sections, planning and collating --
+    are added to stats['seconds'], and the counts of pages, distinct headers,
+    header clusters, valid pairs and sections are stored alongside.
+    '''
+    plan = planvolume(pagelist,backend,pagewords,stats)
+
+    if stats is not None:
+        started = perf_counter()
+
+    collated = [collatepage(idx,page,plan) for idx,page in enumerate(pagelist)]
+
+    if stats is not None:
+        stagetime(stats,'collate',started)
     
-    for idx,page in enumerate(pagelist):
-        if len(page) > 0:                    
-            page[-1] = page[-1].strip()
-            if len(page[-1]) > 0:
-                page[-1] += "\n"
+    return collated
+
+def planvolume(pagelist,backend='index',pagewords=None,stats=None):
+    '''
+    The first half of collate(): counts the words on each page (unless
+    pagewords are passed), finds each page's header and plans the collation
+    (see plancollation).  Returns the plan.  Arguments are as for collate().
+    '''
+    if stats is not None:
+        started = perf_counter()
+
+    if pagewords is None:
+        pagewords = countwords(pagelist)
+        if stats is not None:
+            started = stagetime(stats,'wordcount',started)
+
+    # We keep pageheaders rigorously aligned with pagelist,
+    # so every page gets a 'header,' even if blank.
+
+    pageheaders = [pageheader(page) for page in pagelist]
+
+    if stats is not None:
+        stagetime(stats,'headers',started)
+
+    return plancollation(pageheaders,pagewords,backend,stats)
+
+def layoutvolume(pagelist,backend='index',stats=None):
+    '''
+    Collates a volume without building the collated pages: returns the layout
+    of each page (see pagelayout), which says which of its lines are kept and
+    what goes around them.  That's all a process that has the text already
+    needs to write the volume out (see writeshared).  stats is as for
+    collate(), with working out the layouts timed as 'collate'.
+    '''
+    plan = planvolume(pagelist,backend,stats = stats)
+
+    if stats is not None:
+        started = perf_counter()
+
+    layouts = [pagelayout(idx,page,plan) for idx,page in enumerate(pagelist)]
+
+    if stats is not None:
+        stagetime(stats,'collate',started)
+
+    return layouts
+
+def streamcollate(HTid,rootpath,outputdir,backend='index',compression=None,stats=None):
+    '''
+    Collates a volume straight from its page files (or archive) to disk, without
+    ever holding the whole volume in memory.  A first pass reads the pages one at a time and
+    keeps only each page's header and word count, which is all plancollation()
+    needs; a second pass reads them again and writes each collated page out as
+    it goes.  Gives the same file as collate() followed by writecollated(), and
+    can be compressed the same ways.  Returns the path of the file written.
+    stats is as for collate(), except that the first pass is timed as 'scan'
+    and the second, reading and writing included, as 'collate'.
+    '''
+    if stats is not None:
+        started = perf_counter()
+
+    pageheaders = []
+    pagewords = array('q')
+    for page in filekeeping.iterpages(HTid,rootpath):
+        pageheaders.append(pageheader(page))
+        pagewords.append(pagewordcount(page))
+
+    if stats is not None:
+        stagetime(stats,'scan',started)
+
+    plan = plancollation(pageheaders,pagewords,backend,stats)
+
+    if stats is not None:
+        started = perf_counter()
+
+    pages = filekeeping.iterpages(HTid,rootpath)
+    collated = (collatepage(idx,page,plan) for idx,page in enumerate(pages))
+    outpath = filekeeping.writecollated(HTid,collated,outputdir,compression)
+
+    if stats is not None:
+        stagetime(stats,'collate',started)
+
+    return outpath
+
+def collatevolume(task):
+    '''
+    Worker function for collatemany(). Accepts a (HTid, rootpath) tuple, reads
+    the volume's pages from the pairtree and collates them.  Returns a tuple of
+    HTid, the collated pagelist, and None -- or, if anything goes wrong, HTid,
+    None, and the formatted traceback, so that one bad volume doesn't bring
+    down the whole batch.  The worker's process id and its cache statistics so
+    far ride along at the end of the tuple, followed by the volume's own
+    stats (see collate), with the time spent reading it as 'read'.
+    '''
+    import traceback
+
+    HTid, rootpath = task
+    volumestats = {}
+    try:
+        started = perf_counter()
+        pagelist = filekeeping.loadpagelist(HTid,rootpath)
+        stagetime(volumestats,'read',started)
+        result = HTid, collate(pagelist,stats = volumestats), None
+    except Exception:
+        result = HTid, None, traceback.format_exc()
+
+    return result + (os.getpid(), cachestats(), volumestats)
+
+def collatevolumeshared(task):
+    '''
+    Worker function for collatemany(shared=True).  Like collatevolume(), but
+    rather than sending the collated pages back to be pickled, it puts the
+    volume's text in shared memory (see filekeeping.sharepages) and returns
+    only the name of the block and the layout of each page (see
+    layoutvolume), in place of the collated pagelist.  The process that gets
+    them writes the volume with writeshared(), which frees the block.
+    '''
+    import traceback
+
+    HTid, rootpath = task
+    volumestats = {}
+    try:
+        started = perf_counter()
+        pagelist = filekeeping.loadpagelist(HTid,rootpath)
+        stagetime(volumestats,'read',started)
+        layouts = layoutvolume(pagelist,stats = volumestats)
+        result = HTid, (filekeeping.sharepages(pagelist), layouts), None
+    except Exception:
+        result = HTid, None, traceback.format_exc()
+
+    return result + (os.getpid(), cachestats(), volumestats)
+
+def layoutshared(name):
+    '''For the pipeline's pool of collating processes, when pages travel
+    in shared memory: reads a volume from a block made by
+    filekeeping.sharepages and returns its layouts (see layoutvolume) with
+    its stats.  The block is left for the writer to free.'''
+    volumestats = {}
+    return layoutvolume(filekeeping.sharedpagelist(name),stats = volumestats), volumestats
+
+def sharedcollated(view,layouts):
+    '''Yields the collated pages of a volume whose text is in a corpus held
+    in view, given the layout of each page.  The lines each page keeps are
+    decoded in one piece.'''
+    pagecount, pagestarts, linestarts, text, flags = filekeeping.corpusindex(view)
+    for idx, (prefix, start, end, suffix) in enumerate(layouts):
+        first = pagestarts[idx]
+        if end > start:
+            yield prefix + [str(text[linestarts[first + start]:linestarts[first + end]], 'utf-8')] + suffix
+        else:
+            yield prefix + suffix
+
+def writeshared(HTid,name,layouts,outputdir,compression=None):
+    '''Writes a volume from the shared memory block called name (see
+    filekeeping.sharepages), laid out as layouts, to outputdir, then frees
+    the block.  Gives the same file as writecollated() would with the
+    collated pages.  Returns the path of the file written.'''
+    block = filekeeping.attachshared(name)
+    try:
+        pages = sharedcollated(block.buf,layouts)
+        try:
+            outpath = filekeeping.writecollated(HTid,pages,outputdir,compression)
+        finally:
+            # Drops the views into the block, which can't be closed under them.
+            pages.close()
+    finally:
+        filekeeping.releaseshared(block)
+
+    return outpath
+
+def addcachestats(totals,stats):
+    '''Adds the counters in one cachestats() dictionary into another.'''
+    for cache, info in stats.items():
+        total = totals.setdefault(cache, dict.fromkeys(info, 0))
+        for key, value in info.items():
+            total[key] += value
+
+    return totals
+
+# Volumes run from a hundred pages to several thousand, so a pool that takes
+# a batch in the order given can spend its last minutes with every worker
+# idle but the one that drew a giant book near the end.  With schedule=True,
+# collatemany() estimates each volume's size and hands out the biggest first,
+# and deals the small ones out a few at a time, so that each doesn't cost a
+# round trip to the pool.  The batch is cut into about schedulechunks chunks
+# of work per worker.
+
+schedulechunks = 8
+
+def schedulebatch(htids,rootpath,workers,chunks=schedulechunks):
+    '''
+    Plans a batch for a pool of workers processes.  Each volume's size is
+    estimated from its files (see filekeeping.volumebytes), and a share is
+    the size of the whole batch over workers * chunks.  Going from the
+    biggest volume down, each volume of at least a share goes in a chunk of
+    its own, and smaller ones are grouped until their chunk adds up to a
+    share.  Volumes the same size keep the order they were given in.
+    Returns a list of chunks, each a list of HTids, biggest first, and the
+    total of the estimated sizes.
+    '''
+    htids = list(htids)
+    sizes = [filekeeping.volumebytes(HTid,rootpath) for HTid in htids]
+    share = sum(sizes) / (max(workers, 1) * chunks)
+
+    scheduled = []
+    chunk = []
+    chunkbytes = 0
+    for size, HTid in sorted(zip(sizes, htids), key = lambda pair: pair[0], reverse = True):
+        chunk.append(HTid)
+        chunkbytes += size
+        if chunkbytes >= share:
+            scheduled.append(chunk)
+            chunk = []
+            chunkbytes = 0
+    if len(chunk) > 0:
+        scheduled.append(chunk)
+
+    return scheduled, sum(sizes)
+
+def collatechunk(chunk):
+    '''Worker function for collatemany(schedule=True).  Accepts a tuple of
+    a worker function (collatevolume or collatevolumeshared) and a list of
+    its tasks, and returns a list of what it returns for each.'''
+    worker, tasks = chunk
+    return [worker(task) for task in tasks]
+
+# A batch's journal is synced to disk after this many volumes.  Syncing after
+# every one would be safest, but fsync is slow enough to show on big batches;
+# a crash costs at most this many volumes' work.
+
+journalbatch = 20
+
+def collatemany(htids,rootpath,outputdir,workers=None,chunksize=1,cachetotals=None,compression=None,
+                journal=None,syncevery=None,statsfile=None,stattotals=None,shared=False,schedule=False,
+                report=None,onwritten=None):
+    '''
+    Collates a batch of volumes in parallel.  Volumes are read from the pairtree
+    under rootpath and handed out to a pool of worker processes (by default,
+    one per core).  Each collated volume is written to outputdir as soon as it
+    comes back from the pool, so finished volumes don't wait on slow ones.
+    Output is identical to collating the volumes one at a time, and can be
+    compressed (see filekeeping.writecollated).
+
+    Returns a dictionary mapping the HTid of every volume that failed to the
+    traceback (or error) that stopped it.  An empty dictionary means the whole
+    batch went through.  If a dictionary is passed as cachetotals, it is filled
+    with the cache statistics of all the workers, added together.
+
+    If an open journal is passed (see filekeeping.openjournal), the outcome
+    of each volume is appended to it as it comes in, and the journal is
+    synced to disk every syncevery volumes (by default, journalbatch) and at
+    the end.  If a function is passed as onwritten, it's called with the
+    HTid of each volume as soon as the volume has been written, so that a
+    batch that dies partway has still recorded what it finished.
+
+    Each volume's stats (see collate), with the time spent writing it as
+    'write', go to statsfile as a line of JSON if a file open for writing is
+    passed, and are added into stattotals if a dictionary is passed (see
+    addvolumestats).
+
+    With shared=True, the workers don't send the collated pages back to be
+    pickled: each leaves its volume's text in shared memory and sends back
+    just how every page is laid out (see collatevolumeshared), and the text
+    is written from there.
+
+    With schedule=True, the biggest volumes go first and the small ones go
+    out in chunks (see schedulebatch); chunksize is then ignored.  If a
+    dictionary is passed as report, it gets the number of workers and
+    volumes, the number of chunks if the batch was scheduled, the seconds
+    from starting the pool to writing the last volume as 'makespan', and the
+    total and longest of the time volumes spent on the workers (the sum of
+    their stats, less 'write') as 'volumeseconds' and 'longest';
+    printbatchreport() prints it.
+    '''
+    import multiprocessing
+    import traceback
+
+    failures = {}
+    workerstats = {}
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if report is None:
+        report = {}
+    report.update({'workers': workers, 'volumes': 0, 'makespan': 0, 'volumeseconds': 0, 'longest': 0})
+
+    unsynced = 0
+    if syncevery is None:
+        syncevery = journalbatch
+
+    if shared:
+        filekeeping.sharememory()
+
+    if shared:
+        worker = collatevolumeshared
+    else:
+        worker = collatevolume
+
+    if schedule:
+        scheduled, totalbytes = schedulebatch(htids,rootpath,workers)
+        report['chunks'] = len(scheduled)
+        report['bytes'] = totalbytes
+
+    batchstarted = perf_counter()
+    try:
+        with multiprocessing.Pool(workers) as pool:
+            if schedule:
+                chunks = [(worker, [(HTid, rootpath) for HTid in chunk]) for chunk in scheduled]
+                results = chain.from_iterable(pool.imap_unordered(collatechunk,chunks))
             else:
-                del page[-1]
-            page.append("<pb>\n")
-            header = page[0]
-            header = header.rstrip('\n')
-            if header.isnumeric():
-                del pagelist[idx][0]
-                header = pagelist[idx][0]
-            header = header.strip('0123456789.,!@#$%^&*()[]<> \n')
-            header = header.lower()
+                tasks = ((HTid, rootpath) for HTid in htids)
+                results = pool.imap_unordered(worker,tasks,chunksize)
+            for HTid, pagelist, error, pid, stats, volumestats in results:
+                workerstats[pid] = stats
+                # Counted before 'write' is added: writing happens here, one
+                # volume at a time, not on the workers.
+                seconds = sum(volumestats.get('seconds', {}).values())
+                if error is None:
+                    try:
+                        started = perf_counter()
+                        if shared:
+                            name, layouts = pagelist
+                            writeshared(HTid,name,layouts,outputdir,compression)
+                        else:
+                            filekeeping.writecollated(HTid,pagelist,outputdir,compression)
+                        stagetime(volumestats,'write',started)
+                    except Exception:
+                        # Whatever stops one volume being written (a full
+                        # disk, a compressor that isn't installed) is that
+                        # volume's failure, not the batch's.
+                        error = traceback.format_exc()
+                report['volumes'] += 1
+                report['volumeseconds'] += seconds
+                report['longest'] = max(report['longest'], seconds)
+                if error is None and statsfile is not None:
+                    writevolumestats(statsfile,HTid,volumestats)
+                if error is None and stattotals is not None:
+                    addvolumestats(stattotals,volumestats)
+                if error is not None:
+                    failures[HTid] = error
+                if error is None and onwritten is not None:
+                    onwritten(HTid)
+                if journal is not None:
+                    filekeeping.writejournal(journal,HTid,error)
+                    unsynced += 1
+                    if unsynced >= syncevery:
+                        filekeeping.syncjournal(journal)
+                        unsynced = 0
+    finally:
+        report['makespan'] = perf_counter() - batchstarted
+        if journal is not None:
+            filekeeping.syncjournal(journal)
 
-            if header in remove:
-                del pagelist[idx][0]
-        if idx in divplace:
-            page.insert(0,"<div id=\"" + divplace[idx][1] + "\" code=\"" + str(divplace[idx][3]) + "\" wordcount=\"" + str(divplace[idx][2]) + "\">\n")
-            pagelist[divplace[idx][0]].append("</div>\n")
-    
-    return pagelist
-    
-for HTid in HTids_toprocess:
+    if cachetotals is not None:
+        for stats in workerstats.values():
+            addcachestats(cachetotals,stats)
 
-    # For each HTid, we get a path in the pairtree structure.
-    # Then we read page files, and concatenate them in a list of pages
-    # where each page is a list of lines.
-    
-    path, postfix = filekeeping.pairtreepath(HTid,pairtree_rootpath)
-    pagepath = path + postfix + "/" + postfix + "/"
-    pagefiles = os.listdir(pagepath)
-    pagelist = []
+    return failures
 
-    
-    for f in pagefiles:
-        if f[0] == ".":
+def collateserially(htids,rootpath,outputdir,stream=False,compression=None,withstats=False):
+    '''
+    Collates a batch of volumes one at a time, in this process, writing each
+    to outputdir before reading the next.  With stream=True, each goes
+    through streamcollate().  Yields a tuple of HTid, the exception that
+    stopped it (or None) and its stats (see collate; None unless withstats)
+    as each volume is done.
+    '''
+    for HTid in htids:
+        if withstats:
+            volumestats = {}
+        else:
+            volumestats = None
+        try:
+            if stream:
+                streamcollate(HTid,rootpath,outputdir,compression = compression,stats = volumestats)
+            else:
+                started = perf_counter()
+                pagelist = filekeeping.loadpagelist(HTid,rootpath)
+                if volumestats is not None:
+                    started = stagetime(volumestats,'read',started)
+                pagelist = collate(pagelist,stats = volumestats)
+                started = perf_counter()
+                filekeeping.writecollated(HTid,pagelist,outputdir,compression)
+                if volumestats is not None:
+                    stagetime(volumestats,'write',started)
+            error = None
+        except Exception as e:
+            error = e
+        yield HTid, error, volumestats
+
+def readvolume(HTid,rootpath):
+    '''Loads a volume's pages and returns them with the seconds it took.'''
+    started = perf_counter()
+    pagelist = filekeeping.loadpagelist(HTid,rootpath)
+    return pagelist, perf_counter() - started
+
+def writevolume(HTid,pagelist,outputdir,compression=None):
+    '''Writes a collated volume and returns the seconds it took.'''
+    started = perf_counter()
+    filekeeping.writecollated(HTid,pagelist,outputdir,compression)
+    return perf_counter() - started
+
+def collateprefetched(htids,rootpath,outputdir,depth=2,compression=None,withstats=False):
+    '''
+    Collates a batch of volumes in this process, like collateserially(), but
+    keeps the disk busy while it does.  The next depth volumes are read on a
+    pool of depth threads while the current one is being collated, and
+    collated volumes are written on a thread of their own, with at most depth
+    of them waiting, so the time spent opening and reading files -- most of
+    it, on a network filesystem -- overlaps with collation.  Yields the same
+    tuples as collateserially(), as each volume is written (or fails).  In
+    the stats, 'read' and 'write' are the seconds
+    spent on the threads, which mostly aren't added to the time the batch
+    takes.
+    '''
+    from collections import deque
+    from concurrent.futures import ThreadPoolExecutor
+
+    htids = iter(htids)
+    reading = deque()
+    writing = deque()
+
+    readers = ThreadPoolExecutor(depth)
+    writer = ThreadPoolExecutor(1)
+
+    try:
+        for HTid in islice(htids, depth):
+            reading.append((HTid, readers.submit(readvolume,HTid,rootpath)))
+
+        while reading or writing:
+            if reading:
+                HTid, future = reading.popleft()
+                for nextHTid in islice(htids, 1):
+                    reading.append((nextHTid, readers.submit(readvolume,nextHTid,rootpath)))
+
+                volumestats = {} if withstats else None
+                try:
+                    pagelist, seconds = future.result()
+                    if volumestats is not None:
+                        volumestats['seconds'] = {'read': seconds}
+                    pagelist = collate(pagelist,stats = volumestats)
+                    writing.append((HTid, writer.submit(writevolume,HTid,pagelist,outputdir,compression), volumestats))
+                except Exception as e:
+                    yield HTid, e, volumestats
+
+            # Hand back the volumes written so far, and once depth of them are
+            # queued for writing, wait for the oldest rather than read more.
+
+            while writing and (writing[0][1].done() or len(writing) > depth or not reading):
+                HTid, future, volumestats = writing.popleft()
+                try:
+                    seconds = future.result()
+                    if volumestats is not None:
+                        volumestats['seconds']['write'] = seconds
+                    error = None
+                except Exception as e:
+                    error = e
+                yield HTid, error, volumestats
+    finally:
+        # If the caller stops early, don't go on reading volumes nobody wants.
+        for HTid, future in reading:
+            future.cancel()
+        readers.shutdown(wait = True)
+        writer.shutdown(wait = True)
+
+# The pipeline driver splits a batch into three stages -- reading, collating
+# and writing -- each run by its own set of worker threads, with a bounded
+# queue between one stage and the next.  A stage that gets ahead fills the
+# queue after it and then waits, so however slow the disk or however quick
+# the collation, no more than a few volumes are ever held in memory.  Items
+# passing down the pipeline are lists of [HTid, payload, error, stats], where
+# the payload is the HTid, then the pages, then the collated pages, and error
+# is the first exception the volume ran into, after which the later stages
+# just pass it on.
+
+pipelinestop = None
+
+def collatewithstats(pagelist):
+    '''Collates a volume and returns the collated pages with their stats
+    (see collate).  For the pipeline's pool of collating processes.'''
+    volumestats = {}
+    return collate(pagelist,stats = volumestats), volumestats
+
+def pipelinestage(stage,work,inqueue,outqueue,workers,downstream,report,lock):
+    '''
+    Starts workers threads for one stage of the pipeline.  Each takes items
+    off inqueue and passes them to work, which does the stage's job on the
+    item in place, then puts the item on outqueue, until it takes
+    pipelinestop.  The last worker to stop puts pipelinestop on outqueue once
+    for each of the downstream workers of the next stage.
+
+    report[stage] gets: the number of workers and volumes; busy, the seconds
+    spent working; starved, the seconds spent waiting for something to work
+    on; blocked, the seconds spent waiting for room in outqueue; and the
+    depth of inqueue each time an item was taken, as its total and maximum.
+    Returns the threads.
+    '''
+    import threading
+
+    stagereport = report.setdefault(stage, {'workers': workers, 'volumes': 0, 'busy': 0, 'starved': 0,
+                                            'blocked': 0, 'depthtotal': 0, 'maxdepth': 0})
+    running = [workers]
+
+    def run():
+        while True:
+            started = perf_counter()
+            depth = inqueue.qsize()
+            item = inqueue.get()
+            taken = perf_counter()
+            if item is pipelinestop:
+                break
+            if item[2] is None:
+                try:
+                    work(item)
+                except Exception as e:
+                    item[2] = e
+            done = perf_counter()
+            outqueue.put(item)
+            with lock:
+                stagereport['volumes'] += 1
+                stagereport['starved'] += taken - started
+                stagereport['busy'] += done - taken
+                stagereport['blocked'] += perf_counter() - done
+                stagereport['depthtotal'] += depth
+                stagereport['maxdepth'] = max(stagereport['maxdepth'], depth)
+
+        with lock:
+            running[0] -= 1
+            last = running[0] == 0
+        if last:
+            for i in range(downstream):
+                outqueue.put(pipelinestop)
+
+    threads = [threading.Thread(target = run, name = 'collator-' + stage, daemon = True) for i in range(workers)]
+    for thread in threads:
+        thread.start()
+    return threads
+
+def collatepipeline(htids,rootpath,outputdir,readers=2,collators=1,writers=1,queuesize=4,compression=None,
+                    withstats=False,report=None,shared=False):
+    '''
+    Collates a batch of volumes through a pipeline of three stages, each with
+    its own number of worker threads: readers load volumes' pages (see
+    filekeeping.loadpagelist), collators collate them and writers write them
+    to outputdir.  The stages are joined by queues that hold at most
+    queuesize volumes, so a slow stage holds up the ones before it rather
+    than letting volumes pile up in memory.  With one collator, volumes are
+    collated on its thread; with more, each collator thread hands its volume
+    to a pool of that many processes, so that collation runs in parallel.
+    With shared=True as well, the pages go to the pool in shared memory
+    rather than being pickled, and only their layouts come back (see
+    layoutshared and writeshared).
+
+    Yields the same tuples as collateserially(), as each volume is written
+    (or fails).  If a dictionary is passed as report, it is filled in, stage
+    by stage, with how busy each stage was and how deep the queue in front of
+    it got (see pipelinestage), plus the seconds the whole batch took under
+    'seconds'; printpipelinereport() prints it.
+    '''
+    import queue
+    import threading
+
+    htids = list(htids)
+    if report is None:
+        report = {}
+    lock = threading.Lock()
+    pool = None
+    if collators > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        if shared:
+            filekeeping.sharememory()
+        pool = ProcessPoolExecutor(collators)
+
+    def read(item):
+        started = perf_counter()
+        item[1] = filekeeping.loadpagelist(item[0],rootpath)
+        if item[3] is not None:
+            stagetime(item[3],'read',started)
+
+    def collatestage(item):
+        if pool is None:
+            item[1] = collate(item[1],stats = item[3])
+            return
+        elif shared:
+            name = filekeeping.sharepages(item[1])
+            item[1] = None
+            try:
+                layouts, volumestats = pool.submit(layoutshared,name).result()
+            except BaseException:
+                filekeeping.releaseshared(filekeeping.attachshared(name))
+                raise
+            item[1] = name, layouts
+        else:
+            item[1], volumestats = pool.submit(collatewithstats,item[1]).result()
+        if item[3] is not None:
+            volumestats['seconds'].update(item[3].get('seconds', {}))
+            item[3] = volumestats
+
+    def write(item):
+        started = perf_counter()
+        if pool is not None and shared:
+            name, layouts = item[1]
+            writeshared(item[0],name,layouts,outputdir,compression)
+        else:
+            filekeeping.writecollated(item[0],item[1],outputdir,compression)
+        item[1] = None
+        if item[3] is not None:
+            stagetime(item[3],'write',started)
+
+    # The HTids go in all at once: they're small, and the readers' queue
+    # being full is how the rest of the pipeline holds the readers back.
+
+    toread = queue.Queue()
+    for HTid in htids:
+        toread.put([HTid, HTid, None, {} if withstats else None])
+    for i in range(readers):
+        toread.put(pipelinestop)
+    tocollate = queue.Queue(queuesize)
+    towrite = queue.Queue(queuesize)
+    finished = queue.Queue()
+
+    started = perf_counter()
+    threads = pipelinestage('read',read,toread,tocollate,readers,collators,report,lock)
+    threads += pipelinestage('collate',collatestage,tocollate,towrite,collators,writers,report,lock)
+    threads += pipelinestage('write',write,towrite,finished,writers,1,report,lock)
+
+    try:
+        for i in range(len(htids)):
+            HTid, payload, error, volumestats = finished.get()
+            yield HTid, error, volumestats
+    finally:
+        # If the caller stops early, the readers are told to stop after the
+        # volume they're on, and what's already in the pipeline drains out.
+        while True:
+            try:
+                toread.get_nowait()
+            except queue.Empty:
+                break
+        for i in range(readers):
+            toread.put(pipelinestop)
+        for thread in threads:
+            thread.join()
+        if pool is not None:
+            pool.shutdown()
+        report['seconds'] = perf_counter() - started
+
+def printpipelinereport(report):
+    '''Prints, for each stage of a pipeline run, its workers, the volumes
+    it handled per second, how much of its workers' time went to working,
+    to waiting for work and to waiting for room downstream, and the mean and
+    largest depth of the queue in front of it.'''
+    seconds = report.get('seconds', 0)
+    for stage in ['read', 'collate', 'write']:
+        if stage not in report:
             continue
-        with open(pagepath + f, encoding='utf-8') as file:
-            linelist = file.readlines()
-            pagelist.append(linelist)
+        info = report[stage]
+        capacity = info['workers'] * seconds
+        if seconds > 0 and capacity > 0:
+            rate = info['volumes'] / seconds
+            shares = [info[key] / capacity for key in ['busy', 'starved', 'blocked']]
+        else:
+            rate = 0
+            shares = [0, 0, 0]
+        if info['volumes'] > 0:
+            meandepth = info['depthtotal'] / info['volumes']
+        else:
+            meandepth = 0
+        print(stage + TabChar + 'workers ' + str(info['workers']) + TabChar + format(rate, '.2f') + ' volumes/s' +
+              TabChar + 'busy ' + format(shares[0], '.0%') + TabChar + 'starved ' + format(shares[1], '.0%') +
+              TabChar + 'blocked ' + format(shares[2], '.0%') + TabChar + 'queue mean ' + format(meandepth, '.1f') +
+              ' max ' + str(info['maxdepth']))
 
-    # We're going to keep pageheaders rigorously aligned with pagelist,
-    # so every page gets a 'header,' even if blank.
-    
-    pagelist = collate(pagelist)
-        
-    ## This part will need to be changed or re-written depending on how this is used.
-    ## Right now, it just dumps the text into the collator directory.  It might be
-    ## It might make more sense to make this it's own function.
-
-    with open(collator_directory + "/" + HTid[4:] + ".txt",mode='w',encoding='utf-8') as file:
-        for page in pagelist:
-            for line in page:
-                file.write(line)
-            
\ No newline at end of file
+def printbatchreport(report):
+    '''Prints how long a batch run by collatemany() took (its makespan)
+    beside the total of the time its volumes spent on the workers (see
+    collatemany), and the least it could have
+    taken: that total spread evenly over the workers, or the longest volume,
+    whichever is more.  The last column is that least time over the
+    makespan, which is 100% for a batch that kept every worker busy to the
+    end.'''
+    makespan = report.get('makespan', 0)
+    bound = max(report['volumeseconds'] / report['workers'], report['longest'])
+    if makespan > 0:
+        efficiency = bound / makespan
+    else:
+        efficiency = 0
+    if 'chunks' in report:
+        scheduled = TabChar + str(report['chunks']) + ' chunks'
+    else:
+        scheduled = ''
+    print('batch' + TabChar + str(report['volumes']) + ' volumes on ' + str(report['workers']) + ' workers' + scheduled +
+          TabChar + 'makespan ' + format(makespan, '.3f') + ' s' + TabChar + 'volumes total ' +
+          format(report['volumeseconds'], '.3f') + ' s, longest ' + format(report['longest'], '.3f') + ' s' +
+          TabChar + 'best possible ' + format(bound, '.3f') + ' s (' + format(efficiency, '.0%') + ')')
+
+def writevolumestats(statsfile,HTid,stats):
+    '''Appends one volume's stats (see collate) to an open file as a line of
+    JSON, with the HTid under 'htid'.'''
+    import json
+
+    record = {'htid': HTid}
+    record.update(stats)
+    statsfile.write(json.dumps(record) + '\n')
+
+def addvolumestats(totals,stats):
+    '''Adds one volume's stats into a running total for the batch: the
+    seconds for each stage, the counts, and the number of volumes.'''
+    totals['volumes'] = totals.get('volumes', 0) + 1
+    for key, value in stats.items():
+        if key == 'seconds':
+            seconds = totals.setdefault('seconds', {})
+            for stage, elapsed in value.items():
+                seconds[stage] = seconds.get(stage, 0) + elapsed
+        else:
+            totals[key] = totals.get(key, 0) + value
+
+    return totals
+
+def printvolumestats(totals):
+    '''Prints the time a batch spent in each stage, with its share of the
+    whole, and the totals of the counts.'''
+    seconds = totals.get('seconds', {})
+    whole = sum(seconds.values())
+    for stage, elapsed in sorted(seconds.items(), key = itemgetter(1), reverse = True):
+        if whole > 0:
+            share = elapsed / whole
+        else:
+            share = 0
+        print(stage + TabChar + format(elapsed, '.3f') + ' s' + TabChar + format(share, '.1%'))
+    for key, value in totals.items():
+        if key != 'seconds':
+            print(key + TabChar + str(value))
+
+def printcachestats(stats):
+    '''Prints one line of cache statistics per cache, with its hit rate.'''
+    for cache, info in stats.items():
+        lookups = info['hits'] + info['misses']
+        if lookups > 0:
+            rate = info['hits'] / lookups
+        else:
+            rate = 0
+        print(cache + TabChar + 'hits ' + str(info['hits']) + TabChar + 'misses ' + str(info['misses']) +
+              TabChar + 'size ' + str(info['currsize']) + TabChar + 'hit rate ' + format(rate, '.1%'))
+
+manifestname = 'manifest.txt'
+
+def manifestkey(fingerprint,compression=None):
+    '''
+    The manifest key for a volume: the fingerprint of its source files plus
+    everything else that decides what its collated text looks like -- the
+    collator version, dice_cutoff and the output compression.  The
+    clustering backend isn't part of it, since every backend gives the
+    same result.
+    '''
+    return TabChar.join([fingerprint, 'version=' + collatorversion,
+                         'dice_cutoff=' + repr(dice_cutoff), 'compression=' + str(compression)])
+
+def stalevolumes(htids,rootpath,outputdir,manifest,compression=None,bycontent=False):
+    '''
+    Sorts a batch into the volumes that need collating and the ones that can
+    be skipped.  A volume is skipped only if the manifest has it under the
+    same key it would get now (see manifestkey) and its collated text is
+    still in outputdir.
+
+    Returns a list of the HTids to collate and a dictionary of the keys they
+    should be recorded under once they've been written.  A volume whose
+    source can't be found is always collated, so that the failure gets
+    reported.
+    '''
+    stale = []
+    keys = {}
+    for HTid in htids:
+        fingerprint = filekeeping.sourcefingerprint(HTid,rootpath,bycontent)
+        if fingerprint is None:
+            stale.append(HTid)
+            continue
+        key = manifestkey(fingerprint,compression)
+        outpath = filekeeping.collatedpath(HTid,outputdir,compression)
+        if manifest.get(HTid) == key and os.path.isfile(outpath):
+            continue
+        stale.append(HTid)
+        keys[HTid] = key
+
+    return stale, keys
+
+def main(argv=None):
+    '''
+    Command-line driver.  Collates the HTids given on the command line (or
+    listed one per line in --htidfile, or found in the pairtree with
+    --discover, or failing all those, HTids_toprocess) and writes the results
+    to the output directory.  With --workers, the batch
+    goes through collatemany(); otherwise volumes are collated one at a time.
+    Volumes that failed are listed, one per line with the last line of their
+    error, and the number of them is the return value.  With --pack, volumes
+    are packed into corpus files rather than collated.
+    '''
+    import argparse
+
+    parser = argparse.ArgumentParser(description = 'Collate HathiTrust page files into single texts.')
+    parser.add_argument('htids', nargs = '*', help = 'volume ids to collate')
+    parser.add_argument('--htidfile', help = 'file listing volume ids, one per line')
+    parser.add_argument('--discover', action = 'store_true', help = 'collate every volume found in the pairtree as well')
+    parser.add_argument('--discover-threads', type = int, default = 8, metavar = 'THREADS', help = 'with --discover, walk the pairtree on this many threads')
+    parser.add_argument('--root', help = 'root folder of the pairtree structure')
+    parser.add_argument('--output', default = os.getcwd(), help = 'folder for collated texts')
+    parser.add_argument('--workers', type = int, help = 'collate on a pool of this many processes')
+    parser.add_argument('--compress', choices = ['gzip', 'zstd'], help = 'compress the collated texts')
+    parser.add_argument('--stream', action = 'store_true', help = 'without --workers, read pages one at a time instead of holding whole volumes')
+    parser.add_argument('--cachestats', action = 'store_true', help = 'report header bigram cache hits and misses')
+    parser.add_argument('--incremental', action = 'store_true', help = 'skip volumes unchanged since the last run (see the manifest in the output folder)')
+    parser.add_argument('--rehash', action = 'store_true', help = 'with --incremental, compare file contents rather than sizes and times')
+    parser.add_argument('--journal', help = 'record each volume\'s outcome here, and skip volumes it lists as done')
+    parser.add_argument('--stats', help = 'write the time each volume spent in each stage here, as JSON lines, and print the totals')
+    parser.add_argument('--retry', action = 'store_true', help = 'with --journal, collate only the volumes whose last attempt failed')
+    parser.add_argument('--prefetch', type = int, default = 0, help = 'without --workers, read this many volumes ahead (and write behind) on threads while collating')
+    parser.add_argument('--pipeline', metavar = 'READERS,COLLATORS,WRITERS', help = 'without --workers, run reading, collating and writing as separate stages with this many threads each, and report on them')
+    parser.add_argument('--queuesize', type = int, default = 4, help = 'with --pipeline, how many volumes may wait between one stage and the next')
+    parser.add_argument('--schedule', action = 'store_true', help = 'with --workers, collate the biggest volumes first and hand out small ones in chunks')
+    parser.add_argument('--shared', action = 'store_true', help = 'with --workers, or --pipeline with more than one collator, pass volumes\' text between processes in shared memory rather than pickling it')
+    parser.add_argument('--pack', action = 'store_true', help = 'pack each volume\'s pages into one corpus file in the pairtree, to be read from there, instead of collating')
+    args = parser.parse_args(argv)
+
+    if args.pipeline:
+        try:
+            stageworkers = [int(count) for count in args.pipeline.split(',')]
+        except ValueError:
+            stageworkers = []
+        if len(stageworkers) != 3 or min(stageworkers) < 1:
+            parser.error('--pipeline takes three worker counts, like 2,1,1')
+        if args.stream:
+            parser.error('--pipeline reads whole volumes, so it can\'t be used with --stream')
+        if args.workers:
+            parser.error('--pipeline and --workers are different ways of running a batch; use one')
+    if args.stream and args.workers:
+        parser.error('--workers collates whole volumes, so it can\'t be used with --stream')
+    if args.shared and not args.workers and not (args.pipeline and stageworkers[1] > 1):
+        parser.error('--shared only applies to --workers, or --pipeline with more than one collator')
+    if args.prefetch:
+        if args.stream:
+            parser.error('--prefetch reads whole volumes, so it can\'t be used with --stream')
+        if args.workers:
+            parser.error('--prefetch is for serial runs, so it can\'t be used with --workers')
+        if args.pipeline:
+            parser.error('--pipeline has readers of its own, so it can\'t be used with --prefetch')
+    if args.schedule and not args.workers:
+        parser.error('--schedule orders the batch for a pool of workers, so it needs --workers')
+    if args.rehash and not args.incremental:
+        parser.error('--rehash only applies to --incremental')
+    if args.retry and not args.journal:
+        parser.error('--retry needs a --journal to find the failed volumes in')
+    if args.discover_threads < 1:
+        parser.error('--discover-threads needs at least one thread')
+
+    if args.root:
+        pairtree_rootpath = args.root
+    else:
+        pairtree_rootpath = getpairtreeroot()
+
+    # With --discover, every volume in the pairtree joins the batch, as the
+    # walk finds it (see filekeeping.findvolumes), so the first volumes are
+    # under way while the rest of the tree is still being listed.
+
+    htids = list(args.htids)
+    if args.htidfile:
+        with open(args.htidfile, encoding='utf-8') as file:
+            htids.extend(line.strip() for line in file if line.strip())
+    if args.discover:
+        htids = chain(htids, filekeeping.findvolumes(pairtree_rootpath,args.discover_threads))
+    elif len(htids) == 0:
+        htids = HTids_toprocess
+
+    # With --pack, each volume's page files are packed into a single corpus
+    # file that later runs read instead (see filekeeping.packvolume).
+
+    if args.pack:
+        for HTid in htids:
+            filekeeping.packvolume(HTid,pairtree_rootpath)
+        return 0
+
+    # With --journal, the outcome of every volume is appended to a journal
+    # as it finishes.  Rerunning the same batch with the same journal skips
+    # the volumes already done, so a batch that stopped partway resumes
+    # where it left off; --retry runs just the volumes whose last attempt
+    # failed.
+
+    if args.journal:
+        done, failed = filekeeping.loadjournal(args.journal)
+        if args.retry:
+            htids = list(failed)
+        else:
+            htids = (HTid for HTid in htids if HTid not in done)
+        journal = filekeeping.openjournal(args.journal)
+    else:
+        journal = None
+
+    if args.stats:
+        statsfile = open(args.stats, mode='w', encoding='utf-8')
+        stattotals = {}
+    else:
+        statsfile = None
+        stattotals = None
+
+    # With --incremental, volumes whose sources and parameters match the
+    # manifest are dropped from the batch, and each volume written is
+    # recorded in the manifest.  The manifest is saved even if the run dies
+    # partway, so whatever finished doesn't have to be redone.
+
+    keys = {}
+    if args.incremental:
+        manifestpath = os.path.join(args.output, manifestname)
+        manifest = filekeeping.loadmanifest(manifestpath)
+        htids, keys = stalevolumes(htids,pairtree_rootpath,args.output,manifest,args.compress,args.rehash)
+
+    def recordwritten(HTid):
+        if HTid in keys:
+            manifest[HTid] = keys[HTid]
+
+    try:
+        if args.workers:
+            cachetotals = {}
+            batchreport = {}
+            failures = collatemany(htids,pairtree_rootpath,args.output,workers = args.workers,
+                                   cachetotals = cachetotals,compression = args.compress,journal = journal,
+                                   statsfile = statsfile,stattotals = stattotals,shared = args.shared,
+                                   schedule = args.schedule,report = batchreport,onwritten = recordwritten)
+        else:
+            cachetotals = None
+            failures = {}
+            unsynced = 0
+
+            # For each HTid, we get a path in the pairtree structure.
+            # Then we read page files, and concatenate them in a list of pages
+            # where each page is a list of lines.  With --prefetch, the next
+            # volumes are read (and the last ones written) while one is being
+            # collated; with --pipeline, reading, collating and writing each
+            # have threads of their own.  Without a journal, the first error
+            # stops the run; with one, it's recorded and the run goes on to
+            # the next volume.
+
+            pipelinereport = {}
+
+            if args.pipeline:
+                readers, collators, writers = stageworkers
+                outcomes = collatepipeline(htids,pairtree_rootpath,args.output,readers,collators,writers,
+                                           queuesize = args.queuesize,compression = args.compress,
+                                           withstats = statsfile is not None,report = pipelinereport,
+                                           shared = args.shared)
+            elif args.prefetch:
+                outcomes = collateprefetched(htids,pairtree_rootpath,args.output,depth = args.prefetch,
+                                             compression = args.compress,withstats = statsfile is not None)
+            else:
+                outcomes = collateserially(htids,pairtree_rootpath,args.output,stream = args.stream,
+                                           compression = args.compress,withstats = statsfile is not None)
+
+            # Closed here, so an early stop shuts collateprefetched's threads
+            # down on this thread rather than whenever it's collected.
+
+            try:
+                for HTid, error, volumestats in outcomes:
+                    if error is not None:
+                        if journal is None:
+                            raise error
+                        import traceback
+                        error = ''.join(traceback.format_exception(type(error),error,error.__traceback__))
+                        failures[HTid] = error
+                    elif volumestats is not None:
+                        writevolumestats(statsfile,HTid,volumestats)
+                        addvolumestats(stattotals,volumestats)
+                    if journal is not None:
+                        filekeeping.writejournal(journal,HTid,error)
+                        unsynced += 1
+                        if unsynced >= journalbatch:
+                            filekeeping.syncjournal(journal)
+                            unsynced = 0
+                    if error is None:
+                        recordwritten(HTid)
+            finally:
+                outcomes.close()
+
+            if args.pipeline:
+                printpipelinereport(pipelinereport)
+
+        for HTid, error in failures.items():
+            print(HTid + TabChar + error.strip().split('\n')[-1])
+
+        if args.cachestats:
+            if cachetotals is None:
+                cachetotals = cachestats()
+            printcachestats(cachetotals)
+
+        if stattotals is not None:
+            printvolumestats(stattotals)
+
+        if args.workers:
+            printbatchreport(batchreport)
+
+        return len(failures)
+
+    finally:
+        if statsfile is not None:
+            statsfile.close()
+        if journal is not None:
+            filekeeping.syncjournal(journal)
+            journal.close()
+        if args.incremental:
+            filekeeping.writemanifest(manifestpath,manifest)
+
+if __name__ == '__main__':
+    import sys
+    sys.exit(main())
@@ -3,7 +3,7 @@
     other io modules as appropriate.
 '''
 
-import glob
+import os
 
 DictDirectory = "dictionaries/"
 
@@ -17,6 +17,10 @@ def loadpathdictionary(path_to=""):
     to store paths in a PathDictionary. Any path not in the dictionary,
     we'll have to query the user for -- and then store it in the dictionary.'''
 
+    # glob is only needed here, and it's slow to import, so it waits until
+    # someone actually asks for the path dictionary.
+    import glob
+
     pathdictionary = {}
     
     if path_to == "":
@@ -54,4 +58,742 @@ def pairtreepath(htid,rootpath):
         next_two = postfix[i: (i+2)]
         path = path + next_two + '/'
 
-    return path, postfix   
+    return path, postfix
+
+# findvolumes walks a whole pairtree to list the volumes in it. Under each
+# prefix's pairtree_root, every folder of one or two characters is a step on
+# the way down (see pairtreepath), and a folder with a longer name is a
+# volume's own folder, named for the volume id without its prefix. A volume
+# whose id is only one or two characters long after the prefix has its folder
+# one step down, named like a step; it's told apart by what's in it.
+
+walkdone = None
+
+def holdsvolume(path,postfix):
+    ''' Whether the folder at path holds the pages of the volume whose id
+    ends in postfix: an archive, a packed corpus, or a page folder with page
+    files in it. The page folder alone won't do, since for a longer id
+    starting with postfix it could just as well be the next step down.'''
+    for extension in archiveextensions + [corpusextension]:
+        if os.path.isfile(path + postfix + extension):
+            return True
+    if not os.path.isdir(path + postfix):
+        return False
+    with os.scandir(path + postfix) as entries:
+        return len(orderpagefiles([entry.name for entry in entries if entry.is_file()])) > 0
+
+def walkpairtree(prefix,path,shorties,found,stop):
+    ''' Walks the part of a pairtree under path, which is reached through
+    the folders whose names add up to shorties, and calls found with the
+    HTid of each volume under it, in order of their folders' names, until
+    stop is set. A longer folder counts as a volume's only where
+    pairtreepath would have put it.'''
+
+    with os.scandir(path) as entries:
+        folders = sorted(entry.name for entry in entries if entry.is_dir())
+
+    for name in folders:
+        if stop.is_set():
+            return
+        if len(name) <= 2:
+            if name == shorties and holdsvolume(path + name + "/", name):
+                found(prefix + "." + name)
+            walkpairtree(prefix, path + name + "/", shorties + name, found, stop)
+        elif name[:12] == shorties:
+            found(prefix + "." + name)
+
+def findvolumes(rootpath,threads=8):
+    ''' Yields the HTid of every volume in the pairtree under rootpath as
+    it's found. The folders just under each prefix's pairtree_root are
+    walked in parallel, on a pool of threads, so that the listing of one
+    slow folder doesn't hold up the rest; each yields its volumes in order,
+    but they're mixed together as they come in. Nothing is read but the
+    folders, and the HTids start coming before the walk is done, so a batch
+    can get going without waiting for a tree of millions of volumes to be
+    listed. If the caller stops early, the walk stops too.'''
+    import queue
+    import threading
+    from concurrent.futures import ThreadPoolExecutor
+
+    subtrees = []
+    with os.scandir(rootpath) as entries:
+        prefixes = sorted(entry.name for entry in entries if entry.is_dir())
+    for prefix in prefixes:
+        top = rootpath + prefix + "/pairtree_root/"
+        if not os.path.isdir(top):
+            continue
+        with os.scandir(top) as entries:
+            shorties = sorted(entry.name for entry in entries if entry.is_dir() and len(entry.name) <= 2)
+        subtrees.extend((prefix, top + name + "/", name) for name in shorties)
+
+    found = queue.Queue()
+    stop = threading.Event()
+
+    def walk(subtree):
+        try:
+            prefix, path, shorties = subtree
+            walkpairtree(prefix, path, shorties, found.put, stop)
+        except Exception as e:
+            found.put(e)
+        finally:
+            found.put(walkdone)
+
+    pool = ThreadPoolExecutor(threads)
+    try:
+        for subtree in subtrees:
+            pool.submit(walk, subtree)
+        remaining = len(subtrees)
+        while remaining > 0:
+            htid = found.get()
+            if htid is walkdone:
+                remaining -= 1
+            elif isinstance(htid, Exception):
+                raise htid
+            else:
+                yield htid
+    finally:
+        stop.set()
+        pool.shutdown(wait = True)
+
+def orderpagefiles(names):
+    ''' Given the names of the files in a volume's folder, returns the ones
+    that name page files (like 00000010.txt) in page sequence order. Anything
+    else -- hidden files like .DS_Store, metadata -- is dropped. Only names
+    are looked at, so nothing gets stat'ed.
+
+    Each name has to match the pattern of a page file name in full, so a
+    name with a newline in it can't pass for one. They're then sorted as
+    strings, which is sequence order whenever the numbers are padded to the
+    same width (as HathiTrust's are). If they aren't, we sort by number
+    instead.'''
+
+    # re is only needed here, so it's imported here, like glob above.
+    import re
+
+    pagefilename = re.compile(r'[0-9]+\.txt').fullmatch
+    pagefiles = [name for name in names if pagefilename(name)]
+
+    if len(pagefiles) > 0 and min(map(len, pagefiles)) != max(map(len, pagefiles)):
+        pagefiles.sort(key = lambda name: (int(name[:-4]), name))
+    else:
+        pagefiles.sort()
+
+    return pagefiles
+
+def pagefilepaths(htid,rootpath):
+    ''' Returns the paths of the page files for a volume in the pairtree
+    structure, in page sequence order (see orderpagefiles).'''
+
+    path, postfix = pairtreepath(htid,rootpath)
+    pagepath = path + postfix + "/" + postfix + "/"
+    pagefiles = orderpagefiles(os.listdir(pagepath))
+
+    return [pagepath + f for f in pagefiles]
+
+def readpage(path):
+    ''' Reads one page file and returns it as a list of lines.'''
+    with open(path, encoding='utf-8') as file:
+        return file.readlines()
+
+# HathiTrust delivers volumes as archives of page files. A volume whose pages
+# haven't been extracted into the pairtree can be read straight out of an
+# archive kept in the volume's folder, named for the volume.
+
+archiveextensions = ['.zip', '.tar', '.tar.gz', '.tgz']
+
+def volumearchive(htid,rootpath):
+    ''' Returns the path of the archive holding a volume's page files, or
+    None if there isn't one.'''
+
+    path, postfix = pairtreepath(htid,rootpath)
+    for extension in archiveextensions:
+        archivepath = path + postfix + "/" + postfix + extension
+        if os.path.isfile(archivepath):
+            return archivepath
+
+    return None
+
+def readmember(data):
+    ''' Decodes the bytes of a page file read out of an archive into a list
+    of lines, splitting them exactly as readpage() would the file itself.'''
+    import io
+
+    return io.StringIO(data.decode('utf-8'), newline=None).readlines()
+
+def iterarchivepages(archivepath):
+    ''' Yields the pages in a zip or tar archive, in page sequence order,
+    each as a list of lines, reading one member at a time. Nothing is
+    extracted to disk. Members are matched on their file names, whatever
+    folder they're in, the same way page files are (see orderpagefiles).'''
+
+    if archivepath.endswith('.zip'):
+        import zipfile
+
+        with zipfile.ZipFile(archivepath) as archive:
+            members = {}
+            for name in archive.namelist():
+                members[name.rsplit('/', 1)[-1]] = name
+            for f in orderpagefiles(members):
+                yield readmember(archive.read(members[f]))
+    else:
+        import tarfile
+
+        with tarfile.open(archivepath) as archive:
+            members = {}
+            for member in archive.getmembers():
+                if member.isfile():
+                    members[member.name.rsplit('/', 1)[-1]] = member
+
+            # A compressed tar can only be read forwards: each step back
+            # inflates it again from the start. So members are read in the
+            # order they're stored, which is usually page order already; if
+            # it isn't, the pages are held until their turn comes.
+            pagefiles = orderpagefiles(members)
+            stored = sorted(pagefiles, key = lambda name: members[name].offset)
+            if stored == pagefiles:
+                for f in pagefiles:
+                    with archive.extractfile(members[f]) as file:
+                        yield readmember(file.read())
+            else:
+                pages = {}
+                for f in stored:
+                    with archive.extractfile(members[f]) as file:
+                        pages[f] = readmember(file.read())
+                for f in pagefiles:
+                    yield pages.pop(f)
+
+# A volume's pages can also be packed into a single corpus file in its folder,
+# named for the volume with the extension .pages, which saves opening a file
+# per page. The file starts with a 48-byte header: the magic bytes HTPAGES2,
+# then the number of pages, the number of lines, the byte offset of the
+# indexes, a set of flags and the stamp of the pages it was packed from (see
+# below), each an unsigned 64-bit little-endian integer.
+# Then comes the text of every line of every page, in order, as UTF-8, and
+# then the indexes, in the same format as the header: for each page, the
+# number of the first line on it, and for each line, the offset in the text
+# where it starts. Each index ends with one extra entry, the total, so that
+# page or line n always runs to where n + 1 starts.
+#
+# Pages read from files have a newline at the end of every line but maybe the
+# last, and nowhere else. When that holds for every page, the splitbynewline
+# flag is set, and a page can be decoded in one go and split at its newlines,
+# which is quicker than decoding it line by line.
+#
+# A corpus is a copy of the pages, kept beside them, so it can go stale. When
+# a volume is packed, a stamp of its sources goes into the header: a hash of
+# the page folder's modification time and the number of page files in it, and
+# the archive's size and modification time (see sourcestamp). The corpus is
+# only read while the stamp still matches (see freshcorpus); once it doesn't,
+# the pages are read from their folder or archive until the volume is packed
+# again. Working out the stamp takes a listing of the page folder, but no stat
+# of each page file. Adding, removing or replacing a page file (writing a new
+# one and renaming it into place) changes the folder's modification time; a
+# page file rewritten in place doesn't, so pack the volume again after
+# editing pages that way. Corpora written without a stamp (in shared memory)
+# have 0 there, and older HTPAGES1 corpora have none, so neither is ever read
+# as fresh.
+
+corpusextension = '.pages'
+corpusmagic = b'HTPAGES2'
+corpusheader = 48
+splitbynewline = 1
+
+def corpuspath(htid,rootpath):
+    ''' The path of a volume's packed page corpus, whether or not there is
+    one.'''
+    path, postfix = pairtreepath(htid,rootpath)
+    return path + postfix + "/" + postfix + corpusextension
+
+def sourcestamp(htid,rootpath):
+    ''' Returns the stamp of a volume's sources that its corpus is checked
+    against: a nonzero 64-bit integer that changes whenever its page folder
+    gains, loses or replaces a file, or its archive changes. Returns None if
+    the volume has neither.'''
+    import hashlib
+
+    path, postfix = pairtreepath(htid,rootpath)
+    pagepath = path + postfix + "/" + postfix + "/"
+
+    sources = []
+    if os.path.isdir(pagepath):
+        folder = os.stat(pagepath)
+        sources.append((folder.st_mtime_ns, len(orderpagefiles(os.listdir(pagepath)))))
+    archivepath = volumearchive(htid,rootpath)
+    if archivepath is not None:
+        archive = os.stat(archivepath)
+        sources.append((os.path.basename(archivepath), archive.st_size, archive.st_mtime_ns))
+    if len(sources) == 0:
+        return None
+
+    digest = hashlib.blake2b(repr(sources).encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'little') or 1
+
+def freshcorpus(htid,rootpath):
+    ''' Returns the path of a volume's packed corpus if it has one whose stamp
+    matches its sources as they are now (see sourcestamp), or None. A corpus
+    whose volume has no page folder or archive left is all there is, so it
+    counts as fresh. Only the corpus's header is read.'''
+
+    packedpath = corpuspath(htid,rootpath)
+    try:
+        with open(packedpath, mode='rb') as file:
+            header = file.read(corpusheader)
+    except FileNotFoundError:
+        return None
+
+    if len(header) < corpusheader or header[:8] != corpusmagic:
+        return None
+    stamp = sourcestamp(htid,rootpath)
+    if stamp is not None and int.from_bytes(header[40:48], 'little') != stamp:
+        return None
+
+    return packedpath
+
+def regularpage(page,text):
+    ''' Whether a page's lines are just its text split after each newline:
+    every line but the last ends with one, none has another and none is
+    empty. text is the page's lines joined.'''
+    from itertools import islice
+
+    if len(page) == 0 or "" in page:
+        return len(page) == 0
+    if text.count("\n") != len(page) - (not page[-1].endswith("\n")):
+        return False
+    # So no newline is inside a line, and what's left is to see that every
+    # line but the last ends with one. Joined on a character the text
+    # doesn't have, those are just the newlines followed by it.
+    if "\0" not in text:
+        return "\0".join(page).count("\n\0") == len(page) - 1
+    return all(line.endswith("\n") for line in islice(page, len(page) - 1))
+
+def packcorpus(file,pagelist,stamp=0):
+    ''' Packs pages (any iterable of pages, each a list of lines) into a
+    corpus, written to file, a binary file open for writing at its start,
+    with stamp in its header (see sourcestamp). The text is written as it
+    comes, so the pages needn't all be in memory; only the indexes are.'''
+    import sys
+    from array import array
+    from itertools import accumulate, islice
+
+    pagestarts = array('Q', [0])
+    linestarts = array('Q', [0])
+
+    file.write(bytes(corpusheader))
+    written = 0
+    flags = splitbynewline
+    for page in pagelist:
+        # Each page is encoded in one piece. Only when it isn't all ASCII do
+        # its lines' lengths in bytes differ from their lengths in characters.
+        text = "".join(page)
+        data = text.encode('utf-8')
+        if len(data) == len(text):
+            lengths = map(len, page)
+        else:
+            lengths = [len(line.encode('utf-8')) for line in page]
+        linestarts.extend(islice(accumulate(lengths, initial=written), 1, None))
+        pagestarts.append(len(linestarts) - 1)
+        if flags & splitbynewline and not regularpage(page,text):
+            flags &= ~splitbynewline
+        file.write(data)
+        written += len(data)
+
+    indexoffset = corpusheader + written
+    if sys.byteorder == 'big':
+        pagestarts.byteswap()
+        linestarts.byteswap()
+    file.write(pagestarts.tobytes())
+    file.write(linestarts.tobytes())
+    end = file.tell()
+
+    file.seek(0)
+    file.write(corpusmagic)
+    for number in [len(pagestarts) - 1, len(linestarts) - 1, indexoffset, flags, stamp]:
+        file.write(number.to_bytes(8, 'little'))
+    file.seek(end)
+
+def writecorpus(path,pagelist,stamp=0):
+    ''' Packs pages into a corpus file at path (see packcorpus). Like
+    writecollated, it writes a temporary file and renames it into place.
+    Returns path.'''
+
+    temppath = path + "." + str(os.getpid()) + ".tmp"
+
+    try:
+        with open(temppath, mode='wb') as file:
+            packcorpus(file,pagelist,stamp)
+        os.replace(temppath,path)
+    except BaseException:
+        if os.path.exists(temppath):
+            os.remove(temppath)
+        raise
+
+    return path
+
+def corpusindex(view):
+    ''' Reads a corpus held in a memoryview (of a mapped file, or of shared
+    memory). Returns the number of pages, the page index, the line index, a
+    view of the text and the flags. The indexes are views too, cast to
+    integers, unless this machine is big-endian, when they're byte-swapped
+    copies. Lines first through last - 1 are text[linestarts[first]:
+    linestarts[last]].'''
+    import sys
+
+    if view[:8] != corpusmagic:
+        raise ValueError("Not a page corpus")
+    pagecount, linecount, indexoffset, flags, stamp = [int.from_bytes(view[start:start + 8], 'little')
+                                                       for start in range(8, corpusheader, 8)]
+    lineoffset = indexoffset + 8 * (pagecount + 1)
+    pagestarts = view[indexoffset:lineoffset].cast('Q')
+    linestarts = view[lineoffset:lineoffset + 8 * (linecount + 1)].cast('Q')
+    if sys.byteorder == 'big':
+        from array import array
+        pagestarts = array('Q', pagestarts)
+        pagestarts.byteswap()
+        linestarts = array('Q', linestarts)
+        linestarts.byteswap()
+
+    return pagecount, pagestarts, linestarts, view[corpusheader:indexoffset], flags
+
+def itercorpusview(view):
+    ''' Yields the pages of a corpus held in a memoryview one at a time,
+    each as a list of lines, decoded straight out of the view.'''
+    pagecount, pagestarts, linestarts, text, flags = corpusindex(view)
+
+    for idx in range(pagecount):
+        first = pagestarts[idx]
+        last = pagestarts[idx + 1]
+        if flags & splitbynewline:
+            # splitlines also breaks at \r, \f and the like, but only ever
+            # into more lines than there should be, so if the count is right
+            # it broke at the newlines alone.
+            lines = str(text[linestarts[first]:linestarts[last]], 'utf-8').splitlines(True)
+            if len(lines) == last - first:
+                yield lines
+                continue
+        yield [str(text[linestarts[line]:linestarts[line + 1]], 'utf-8') for line in range(first, last)]
+
+def itercorpuspages(path):
+    ''' Yields the pages of a corpus file one at a time, each as a list of
+    lines. The file is memory-mapped, not read: each page is decoded straight
+    out of the mapping, so only the pages asked for are ever touched.'''
+    import mmap
+
+    with open(path, mode='rb') as file:
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapping:
+            view = memoryview(mapping)
+            pages = itercorpusview(view)
+            try:
+                yield from pages
+            finally:
+                # The mapping can't be closed while views of it are alive.
+                pages.close()
+                view.release()
+
+# Volumes collated on a pool of processes can travel between them in shared
+# memory, packed as a corpus, rather than being pickled. Whichever process
+# makes a block hands it over to the one that writes it out, which frees it
+# when done (see releaseshared). Every process has to share one resource
+# tracker, which keeps a single record of the blocks that are live, so call
+# sharememory before starting the pool.
+
+def sharememory():
+    ''' Starts this process's resource tracker, if it hasn't been, so that
+    processes started from now on use it rather than each starting their own,
+    which would take blocks made in one process and freed in another for
+    leaks. Any blocks still live when the tracker stops are freed then.'''
+    if os.name == 'posix':
+        from multiprocessing import resource_tracker
+        resource_tracker.ensure_running()
+
+def sharepages(pagelist):
+    ''' Packs pages into a new block of shared memory, as a corpus, and
+    returns the block's name.'''
+    import io
+    from multiprocessing import shared_memory
+
+    packed = io.BytesIO()
+    packcorpus(packed,pagelist)
+    data = packed.getbuffer()
+
+    block = shared_memory.SharedMemory(create=True, size=max(len(data), 1))
+    try:
+        block.buf[:len(data)] = data
+    except BaseException:
+        block.close()
+        block.unlink()
+        raise
+    finally:
+        data.release()
+    name = block.name
+    block.close()
+
+    return name
+
+def attachshared(name):
+    ''' Attaches to a block of shared memory made by sharepages and returns
+    it. Its buf is the corpus.'''
+    from multiprocessing import shared_memory
+
+    return shared_memory.SharedMemory(name=name)
+
+def sharedpagelist(name):
+    ''' Reads the pages in a block of shared memory made by sharepages,
+    leaving the block for whoever will free it. Returns a list of pages,
+    each a list of lines.'''
+    block = attachshared(name)
+    try:
+        return list(itercorpusview(block.buf))
+    finally:
+        block.close()
+
+def releaseshared(block):
+    ''' Detaches from a block of shared memory and frees it.'''
+    block.close()
+    block.unlink()
+
+def packvolume(htid,rootpath):
+    ''' Packs a volume's pages, from its page folder or archive, into a
+    corpus file in its folder (see corpuspath). Returns the path of the
+    corpus. Once the pages change, the corpus is passed over (see
+    freshcorpus) until the volume is packed again.'''
+
+    # The stamp is taken before the pages are read, so that pages changed
+    # while they're being packed leave the corpus stale.
+    stamp = sourcestamp(htid,rootpath)
+    return writecorpus(corpuspath(htid,rootpath), iterpages(htid,rootpath,corpus=False), stamp)
+
+def iterpages(htid,rootpath,corpus=True):
+    ''' Yields a volume's pages one at a time, in sequence order, each as a
+    list of lines. Pages come from the volume's packed corpus if it has one
+    that's up to date (see packvolume and freshcorpus), or else its page
+    folder in the pairtree, or else its archive (see volumearchive). With
+    corpus=False the corpus is passed over.'''
+
+    path, postfix = pairtreepath(htid,rootpath)
+    pagepath = path + postfix + "/" + postfix + "/"
+
+    packedpath = freshcorpus(htid,rootpath) if corpus else None
+    if packedpath is not None:
+        yield from itercorpuspages(packedpath)
+        return
+
+    if os.path.isdir(pagepath):
+        for pagefile in pagefilepaths(htid,rootpath):
+            yield readpage(pagefile)
+        return
+
+    archivepath = volumearchive(htid,rootpath)
+    if archivepath is None:
+        raise FileNotFoundError("No page folder or archive for " + htid + " under " + path)
+
+    yield from iterarchivepages(archivepath)
+
+def sourcefingerprint(htid,rootpath,bycontent=False):
+    ''' Returns a hash of a volume's source files -- its packed corpus if
+    it's up to date, its page files, or else its archive, whichever
+    iterpages would read -- that changes whenever they do. By default only the name, size and
+    modification time of each file go into it, so nothing is read; with
+    bycontent=True the bytes themselves are hashed, which catches edits that
+    keep a file's size and timestamp but means reading the volume. Returns
+    None if the volume has no pages to fingerprint.'''
+    import hashlib
+
+    path, postfix = pairtreepath(htid,rootpath)
+    pagepath = path + postfix + "/" + postfix + "/"
+
+    packedpath = freshcorpus(htid,rootpath)
+    if packedpath is not None:
+        sourcefiles = [packedpath]
+    elif os.path.isdir(pagepath):
+        sourcefiles = pagefilepaths(htid,rootpath)
+    else:
+        archivepath = volumearchive(htid,rootpath)
+        if archivepath is None:
+            return None
+        sourcefiles = [archivepath]
+
+    digest = hashlib.sha1()
+    for sourcefile in sourcefiles:
+        digest.update(os.path.basename(sourcefile).encode('utf-8'))
+        if bycontent:
+            with open(sourcefile, mode='rb') as file:
+                digest.update(file.read())
+        else:
+            info = os.stat(sourcefile)
+            digest.update((TabChar + str(info.st_size) + TabChar + str(info.st_mtime_ns)).encode('utf-8'))
+        digest.update(b"\n")
+
+    return digest.hexdigest()
+
+def volumebytes(htid,rootpath):
+    ''' A cheap estimate of how much text a volume has, for scheduling a
+    batch: the size in bytes of whatever iterpages would read -- its packed
+    corpus, its page files, or else its archive, which being compressed will
+    look smaller than it is. Only directory entries and file sizes are
+    looked at; nothing is opened. Returns 0 if the volume can't be found.'''
+
+    path, postfix = pairtreepath(htid,rootpath)
+    pagepath = path + postfix + "/" + postfix + "/"
+
+    packedpath = freshcorpus(htid,rootpath)
+    if packedpath is not None:
+        return os.path.getsize(packedpath)
+
+    if os.path.isdir(pagepath):
+        with os.scandir(pagepath) as entries:
+            found = {entry.name: entry for entry in entries}
+        return sum(found[name].stat().st_size for name in orderpagefiles(found))
+
+    archivepath = volumearchive(htid,rootpath)
+    if archivepath is None:
+        return 0
+    return os.path.getsize(archivepath)
+
+def loadpagelist(htid,rootpath):
+    ''' Reads the pages of a volume out of the pairtree structure (or its
+    corpus or archive, see iterpages) and returns them as a list of pages, where each page is a list
+    of lines.'''
+
+    return list(iterpages(htid,rootpath))
+
+# A manifest records, for each volume collated into an output folder, a key
+# made of the hash of its source files and the parameters it was collated
+# with. It's a tab-separated text file, one volume per line, like the
+# PathDictionary.
+
+def loadmanifest(path):
+    ''' Reads a manifest into a dictionary of HTid -> key. A missing
+    manifest is an empty one.'''
+
+    manifest = {}
+    if not os.path.isfile(path):
+        return manifest
+
+    with open(path, encoding='utf-8') as file:
+        for workline in file:
+            workline = workline.rstrip("\n")
+            if workline == "":
+                continue
+            htid, key = workline.split(TabChar, 1)
+            manifest[htid] = key
+
+    return manifest
+
+def writemanifest(path,manifest):
+    ''' Writes a dictionary of HTid -> key to path, replacing it in one
+    step so that an interrupted write leaves the old manifest intact.'''
+
+    temppath = path + "." + str(os.getpid()) + ".tmp"
+    with open(temppath, mode='w', encoding='utf-8') as file:
+        for htid in sorted(manifest):
+            file.write(htid + TabChar + manifest[htid] + "\n")
+    os.replace(temppath,path)
+
+# A journal records how each volume in a batch turned out, one line per volume
+# as it finishes, so that a batch that stops partway can pick up where it left
+# off. Lines are only ever appended: "done", tab, HTid; or "failed", tab, HTid,
+# tab, and the error (escaped onto one line). If a volume appears more than
+# once, its last line counts.
+
+def loadjournal(path):
+    ''' Reads a journal and returns the set of HTids that finished, and a
+    dictionary of HTid -> error for those whose last attempt failed. A
+    missing journal is an empty one; so is a last line cut off by a crash.'''
+    import json
+
+    done = set()
+    failed = {}
+    if not os.path.isfile(path):
+        return done, failed
+
+    with open(path, encoding='utf-8') as file:
+        for workline in file:
+            if not workline.endswith("\n"):
+                break
+            fields = workline.rstrip("\n").split(TabChar)
+            if fields[0] == 'done' and len(fields) == 2:
+                done.add(fields[1])
+                failed.pop(fields[1], None)
+            elif fields[0] == 'failed' and len(fields) == 3:
+                done.discard(fields[1])
+                failed[fields[1]] = json.loads(fields[2])
+
+    return done, failed
+
+def openjournal(path):
+    ''' Opens a journal to append to.'''
+    return open(path, mode='a', encoding='utf-8')
+
+def writejournal(journal,htid,error=None):
+    ''' Appends one volume's outcome to an open journal: done if error is
+    None, otherwise failed, with the error. Nothing is forced to disk;
+    that's syncjournal's job.'''
+    import json
+
+    if error is None:
+        journal.write('done' + TabChar + htid + "\n")
+    else:
+        journal.write('failed' + TabChar + htid + TabChar + json.dumps(error) + "\n")
+
+def syncjournal(journal):
+    ''' Pushes everything written to a journal out to disk.'''
+    journal.flush()
+    os.fsync(journal.fileno())
+
+# Collated volumes can be written compressed. Each kind of compression adds its
+# usual suffix to the file name. zstd needs the zstandard package.
+
+compressionsuffixes = {None: '', 'gzip': '.gz', 'zstd': '.zst'}
+
+def openoutput(path,compression=None):
+    ''' Opens path to write utf-8 text, through gzip or zstd compression if
+    asked for.'''
+
+    if compression is None:
+        return open(path,mode='w',encoding='utf-8')
+    elif compression == 'gzip':
+        import gzip
+        # gzip.open defaults to level 9, which costs far more time than level
+        # 6 (zlib's own default) for next to no saving on OCR text.
+        return gzip.open(path,mode='wt',encoding='utf-8',compresslevel=6)
+    elif compression == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError("zstd output needs the zstandard package (pip install zstandard)")
+        return zstandard.open(path,mode='wt',encoding='utf-8')
+    else:
+        raise ValueError("Unknown compression: " + str(compression))
+
+def collatedpath(htid,outputdir,compression=None):
+    ''' The path a collated volume is written to: a text file in outputdir
+    named for the whole volume id, prefix and postfix (as pairtreepath splits
+    them), so that volumes from different sources never share a name. The
+    characters that can't go in a file name are swapped the way pairtree
+    swaps them, ':' for '+' and '/' for '='.'''
+    name = htid.replace(":", "+").replace("/", "=")
+    return os.path.join(outputdir, name + ".txt" + compressionsuffixes[compression])
+
+def writecollated(htid,pagelist,outputdir,compression=None):
+    ''' Writes a collated volume (pages, each a list of lines) to a single
+    text file in outputdir. pagelist can be any iterable of pages, so a
+    generator of collated pages is written as it's produced. Each page goes
+    out as one joined write, into a temporary file beside the real one that
+    is renamed into place only when the whole volume has been written; a
+    crash never leaves a half-written volume behind under the real name.
+    Returns the path of the file written.'''
+
+    outpath = collatedpath(htid,outputdir,compression)
+    temppath = outpath + "." + str(os.getpid()) + ".tmp"
+
+    try:
+        with openoutput(temppath,compression) as file:
+            for page in pagelist:
+                file.write(''.join(page))
+        os.replace(temppath,outpath)
+    except BaseException:
+        if os.path.exists(temppath):
+            os.remove(temppath)
+        raise
+
+    return outpath
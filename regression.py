@@ -0,0 +1,437 @@
+'''
+    Golden-output checks for the collator. The sample volumes bundled with
+    the collator are split back into pages (see benchmark.samplepages), a
+    few synthetic books are generated, and each is collated again; the
+    result has to match, page for page, the golden copy kept in golden/.
+    testnotes.rtf records by hand what the segmentation of some of these
+    volumes should look like; this checks that nothing has moved since the
+    golden copies were made, so a faster engine can be shown to give the
+    same output as the one it replaces.
+
+    Usage:  python regression.py [--update] [volume ...]
+
+    Every volume is collated with collate() on each clustering backend that
+    can run here, streamed from a pairtree with streamcollate(), and read
+    back from a packed page corpus (see filekeeping.packvolume); it also
+    goes through a worker process and back in shared memory (see
+    collatemany's shared option). For each, three things are compared
+    with the golden copy: the section code
+    of every page, the <div> metadata (name, code, word count, first and
+    last page of each section), and the text of every page. The first few
+    differences of each kind are printed.
+
+    When no volumes are named, the checks below are run as well (see
+    checks): mostly equivalences between a faster routine and the one it
+    replaced, which benchmark.py times but doesn't test. The number of
+    volumes and checks that fail is the exit status.
+
+    --update rewrites the golden copies from the current code. Only do that
+    when a change to the output is intended, and bump collatorversion with it.
+'''
+
+import copy
+import gzip
+import json
+import os
+import re
+import sys
+import tempfile
+
+import collator
+import filekeeping
+from benchmark import (backends, gappedcodes, inmemorycollate, noisyheaders, quadraticrepair,
+                       samplepages, samplevolumes, syntheticbook, tracedpeak, writepairtree)
+
+collator_directory = os.path.dirname(os.path.abspath(__file__))
+golden_directory = os.path.join(collator_directory, 'golden')
+
+# Synthetic books checked alongside the samples: name -> pages, distinct
+# running headers, OCR noise rate (see benchmark.syntheticbook).
+
+syntheticvolumes = {'synthetic-400p-12h': (400, 12, .05), 'synthetic-1000p-30h': (1000, 30, .3)}
+
+# How many differences of each kind to print for a volume.
+
+shown = 5
+
+def volumes():
+    '''Returns a dictionary of name -> pagelist for every volume checked.'''
+    found = {}
+    for path in samplevolumes():
+        found[os.path.basename(path)[:-4]] = samplepages(path)
+    for name, (pages, vocabulary, noise) in syntheticvolumes.items():
+        found[name] = syntheticbook(pages, vocabulary, noise)
+    return found
+
+def splitcollated(text):
+    '''
+    Takes collated text apart again. Returns a list of pages, each a list of
+    lines with the <div> and </div> tags left in, and a list of sections,
+    each [name, code, wordcount, first page, last page], in order. Every page
+    ends with its <pb>, except that a </div> closing a section on its own
+    page comes after it.
+    '''
+    pages = []
+    sections = []
+    page = []
+
+    for line in text.splitlines(keepends = True):
+        opening = re.match('<div id="(.*)" code="([0-9]+)" wordcount="([0-9]+)">\n', line)
+        if opening:
+            sections.append([opening.group(1), int(opening.group(2)), int(opening.group(3)), len(pages), None])
+        if line == '</div>\n' and len(sections) > 0:
+            # A </div> after the <pb> belongs to the page just finished.
+            sections[-1][4] = len(pages) - 1 if len(page) == 0 else len(pages)
+            if len(page) == 0 and len(pages) > 0:
+                pages[-1].append(line)
+                continue
+        page.append(line)
+        if line == '<pb>\n':
+            pages.append(page)
+            page = []
+
+    if len(page) > 0:
+        pages.append(page)
+
+    return pages, sections
+
+def sectioncodes(pagecount, sections):
+    '''The code of the section each page belongs to, or -1 for a page that
+    falls outside every <div>.'''
+    codes = [-1] * pagecount
+    for name, code, wordcount, first, last in sections:
+        if last is None:
+            last = pagecount - 1
+        for idx in range(first, min(last + 1, pagecount)):
+            codes[idx] = code
+    return codes
+
+def goldenpaths(name):
+    '''The paths of a volume's golden text and golden sections.'''
+    base = os.path.join(golden_directory, name)
+    return base + '.txt.gz', base + '.sections.json'
+
+def writegolden(name, text):
+    '''Saves collated text as the golden copy for a volume, along with its
+    sections and section codes as JSON, which is easier to read in a diff.'''
+    textpath, sectionpath = goldenpaths(name)
+    pages, sections = splitcollated(text)
+    # mtime=0 keeps the gzip header, and so the file, the same from run to run.
+    with open(textpath, mode='wb') as file:
+        file.write(gzip.compress(text.encode('utf-8'), compresslevel = 9, mtime = 0))
+    with open(sectionpath, mode='w', encoding='utf-8') as file:
+        json.dump({'pages': len(pages), 'sections': sections,
+                   'sectioncodes': sectioncodes(len(pages), sections)}, file, indent = 1)
+        file.write('\n')
+
+def loadgolden(name):
+    '''Returns the golden text and golden sections of a volume, or None and
+    None if it has no golden copy yet.'''
+    textpath, sectionpath = goldenpaths(name)
+    if not os.path.isfile(textpath) or not os.path.isfile(sectionpath):
+        return None, None
+    with gzip.open(textpath, mode='rt', encoding='utf-8', newline='') as file:
+        text = file.read()
+    with open(sectionpath, encoding='utf-8') as file:
+        return text, json.load(file)
+
+def differences(text, golden, goldensections):
+    '''
+    Compares collated text with a volume's golden copy. Returns a list of
+    messages, one per difference found, by kind: section codes, <div>
+    metadata, then page text. An empty list means they match.
+    '''
+    import difflib
+
+    found = []
+    pages, sections = splitcollated(text)
+    goldenpages, ignored = splitcollated(golden)
+
+    if len(pages) != len(goldenpages):
+        found.append('%d pages where the golden copy has %d' % (len(pages), len(goldenpages)))
+
+    codes = sectioncodes(len(pages), sections)
+    changed = [idx for idx, (code, expected) in enumerate(zip(codes, goldensections['sectioncodes'])) if code != expected]
+    for idx in changed[:shown]:
+        found.append('section code of page %d is %d, not %d' % (idx, codes[idx], goldensections['sectioncodes'][idx]))
+    if len(changed) > shown:
+        found.append('... %d more pages with a different section code' % (len(changed) - shown))
+
+    if len(sections) != len(goldensections['sections']):
+        found.append('%d sections where the golden copy has %d' % (len(sections), len(goldensections['sections'])))
+    changed = [(section, expected) for section, expected in zip(sections, goldensections['sections']) if section != expected]
+    for section, expected in changed[:shown]:
+        found.append('<div> %s, not %s' % (json.dumps(section), json.dumps(expected)))
+    if len(changed) > shown:
+        found.append('... %d more <div>s that differ' % (len(changed) - shown))
+
+    changed = [idx for idx, (page, expected) in enumerate(zip(pages, goldenpages)) if page != expected]
+    for idx in changed[:shown]:
+        diff = difflib.unified_diff(goldenpages[idx], pages[idx], 'golden', 'now', n = 1)
+        found.append('text of page %d differs:\n    %s' % (idx, '    '.join(list(diff)[2:]).rstrip()))
+    if len(changed) > shown:
+        found.append('... %d more pages whose text differs' % (len(changed) - shown))
+
+    return found
+
+def collatedtexts(name, pagelist, scratch):
+    '''Collates a volume every way it can be collated here and returns a
+    dictionary of way -> collated text.'''
+    texts = {}
+    original = copy.deepcopy(pagelist)
+    for backend in backends():
+        collated = collator.collate(pagelist, backend)
+        if pagelist != original:
+            raise AssertionError('collate() changed the pages it was given for ' + name)
+        texts['collate/' + backend] = ''.join(''.join(page) for page in collated)
+
+    rootpath = os.path.join(scratch, 'collection') + '/'
+    outputdir = os.path.join(scratch, 'output')
+    os.makedirs(outputdir, exist_ok = True)
+    HTid = 'reg.' + name
+    writepairtree(rootpath, {HTid: pagelist})
+    outpath = collator.streamcollate(HTid, rootpath, outputdir)
+    with open(outpath, encoding='utf-8', newline='') as file:
+        texts['streamcollate'] = file.read()
+
+    failures = collator.collatemany([HTid], rootpath, outputdir, workers = 1, shared = True)
+    if failures:
+        raise AssertionError('collatemany() failed on ' + name + ':\n' + failures[HTid])
+    with open(filekeeping.collatedpath(HTid, outputdir), encoding='utf-8', newline='') as file:
+        texts['shared'] = file.read()
+
+    filekeeping.packvolume(HTid, rootpath)
+    collated = collator.collate(filekeeping.loadpagelist(HTid, rootpath))
+    texts['corpus'] = ''.join(''.join(page) for page in collated)
+
+    return texts
+
+def checkdice():
+    '''The vectorized bitset Dice scores (see collator.bitsetdice) against
+    dicecoefficient(), on every pair of a few hundred noisy headers.'''
+    if 'numpy' not in backends():
+        return []
+
+    headers = sorted(set(noisyheaders(600, 600, seed = 1)))
+    headers += ['chapter i', 'chapter ii', 'introduction', 'préface', '$$', '']
+    bigramsets = [collator.getbigrams(header) for header in headers]
+    bitsets, sizes = collator.bigrambitsets(headers)
+
+    found = []
+    for idx, first in enumerate(bigramsets):
+        expected = [collator.dicecoefficient(first, second) for second in bigramsets]
+        if list(collator.bitsetdice(bitsets[idx], sizes[idx], bitsets, sizes)) != expected:
+            found.append('bitset Dice differs for ' + repr(headers[idx]))
+    return found
+
+def checkrepair():
+    '''collator.repairsections() against the loop it replaced (see
+    benchmark.quadraticrepair): on synthetic section codes with runs of
+    invalid pages of several lengths, on a few edge cases, and on every
+    sample volume collated with each.'''
+    found = []
+    cases = [[], [999], [999] * 5, [999, 999, 3, 999], [3, 999, 999], [1, 999, 999, 999, 2]]
+    for seed in range(3):
+        for gap in [1, 10, 100, 1000]:
+            cases.append(gappedcodes(5000, gap, seed))
+    for codes in cases:
+        if collator.repairsections(list(codes)) != quadraticrepair(list(codes)):
+            found.append('repairs disagree on %d pages of codes beginning %r' % (len(codes), codes[:8]))
+
+    repair = collator.repairsections
+    for path in samplevolumes():
+        pagelist = samplepages(path)
+        try:
+            collator.repairsections = quadraticrepair
+            expected = collator.collate(copy.deepcopy(pagelist))
+        finally:
+            collator.repairsections = repair
+        if collator.collate(pagelist) != expected:
+            found.append('repair changed the collation of ' + os.path.basename(path))
+    return found
+
+# What streamcollate() may keep per page, in bytes: the page's header and
+# word count, and its share of the collation plan. Holding the page itself
+# would cost more than twice this on every sample volume.
+
+pagebookkeeping = 1536
+
+def checkmemory():
+    '''
+    Streaming a volume with streamcollate() has to give the same file as
+    collating it whole, and must not hold pages in memory. For every sample
+    volume, the peak traced while streaming it is compared with the peak
+    while streaming the same pages twice over: the difference has to be no
+    more than pagebookkeeping bytes for each page added.
+    '''
+    found = []
+    with tempfile.TemporaryDirectory() as scratch:
+        rootpath = os.path.join(scratch, 'collection') + '/'
+        outputdir = os.path.join(scratch, 'output')
+        os.makedirs(outputdir)
+        for path in samplevolumes():
+            name = os.path.basename(path)[:-4]
+            pagelist = samplepages(path)
+            writepairtree(rootpath, {'reg.once': pagelist, 'reg.twice': pagelist * 2})
+
+            with open(inmemorycollate('reg.once', rootpath, outputdir), encoding='utf-8') as file:
+                whole = file.read()
+            # The first call pays for one-time setup, which isn't per page.
+            collator.streamcollate('reg.once', rootpath, outputdir)
+            once, outpath = tracedpeak(collator.streamcollate, 'reg.once', rootpath, outputdir)
+            with open(outpath, encoding='utf-8') as file:
+                if file.read() != whole:
+                    found.append('streaming changed the output of ' + name)
+            twice, outpath = tracedpeak(collator.streamcollate, 'reg.twice', rootpath, outputdir)
+
+            perpage = (twice - once) / len(pagelist)
+            if perpage > pagebookkeeping:
+                found.append('streaming %s takes %d bytes more for each page added (at most %d)'
+                             % (name, perpage, pagebookkeeping))
+    return found
+
+def checkcorpus():
+    '''
+    A packed corpus (see filekeeping.packvolume) is only read while it's in
+    step with its pages. Packs a small volume, then adds, replaces and
+    removes page files, and changes its archive, checking each time that
+    the pages are read from their source rather than the stale corpus.
+    '''
+    import zipfile
+
+    found = []
+    pagelist = syntheticbook(40, 4, 0)
+    with tempfile.TemporaryDirectory() as scratch:
+        rootpath = os.path.join(scratch, 'collection') + '/'
+        HTid = 'reg.corpus'
+        writepairtree(rootpath, {HTid: pagelist})
+        path, postfix = filekeeping.pairtreepath(HTid, rootpath)
+        pagepath = path + postfix + '/' + postfix + '/'
+
+        def repacked(what, expected):
+            filekeeping.packvolume(HTid, rootpath)
+            if filekeeping.freshcorpus(HTid, rootpath) is None:
+                found.append('the corpus is stale as soon as it is packed, ' + what)
+            if filekeeping.loadpagelist(HTid, rootpath) != expected:
+                found.append('the corpus gives the wrong pages, ' + what)
+
+        def stale(what, expected):
+            if filekeeping.freshcorpus(HTid, rootpath) is not None:
+                found.append('the corpus is still read after ' + what)
+            if filekeeping.loadpagelist(HTid, rootpath) != expected:
+                found.append('the pages read after ' + what + ' are not the new ones')
+
+        repacked('packed from a page folder', pagelist)
+
+        with open(pagepath + '%08d.txt' % (len(pagelist) + 1), mode='w', encoding='utf-8') as file:
+            file.write('an added page\n')
+        pagelist = pagelist + [['an added page\n']]
+        stale('adding a page file', pagelist)
+        repacked('after adding a page file', pagelist)
+
+        with open(pagepath + 'replacement', mode='w', encoding='utf-8') as file:
+            file.write('a replaced page\n')
+        os.replace(pagepath + 'replacement', pagepath + '00000001.txt')
+        pagelist = [['a replaced page\n']] + pagelist[1:]
+        stale('replacing a page file', pagelist)
+        repacked('after replacing a page file', pagelist)
+
+        os.remove(pagepath + '%08d.txt' % len(pagelist))
+        pagelist = pagelist[:-1]
+        stale('removing a page file', pagelist)
+        repacked('after removing a page file', pagelist)
+
+        archivepath = path + postfix + '/' + postfix + '.zip'
+        with zipfile.ZipFile(archivepath, 'w') as archive:
+            for pagefile in filekeeping.pagefilepaths(HTid, rootpath):
+                archive.write(pagefile, postfix + '/' + os.path.basename(pagefile))
+        for pagefile in filekeeping.pagefilepaths(HTid, rootpath):
+            os.remove(pagefile)
+        os.rmdir(pagepath)
+        stale('the page folder gives way to an archive', pagelist)
+        repacked('from an archive', pagelist)
+
+        with zipfile.ZipFile(archivepath, 'a') as archive:
+            archive.writestr(postfix + '/%08d.txt' % (len(pagelist) + 1), 'an archived page\n')
+        pagelist = pagelist + [['an archived page\n']]
+        stale('adding a page to the archive', pagelist)
+        repacked('after adding a page to the archive', pagelist)
+
+        os.remove(archivepath)
+        if filekeeping.loadpagelist(HTid, rootpath) != pagelist:
+            found.append('the corpus isn\'t read once it is all that\'s left')
+    return found
+
+# Checks run on a full run, by name. Each returns a list of messages, one
+# per failure; an empty list means it passed.
+
+checks = {'dice': checkdice, 'repair': checkrepair, 'memory': checkmemory, 'corpus': checkcorpus}
+
+def main(argv=None):
+    '''Checks (or, with --update, rewrites) the golden copies. Returns the
+    number of volumes whose output differs from them.'''
+    import argparse
+
+    everything = volumes()
+    parser = argparse.ArgumentParser(description = 'Check the collator\'s output against golden copies.')
+    parser.add_argument('volumes', nargs = '*', help = 'volumes to check (default: all): ' + ', '.join(everything))
+    parser.add_argument('--update', action = 'store_true', help = 'rewrite the golden copies from the current code')
+    args = parser.parse_args(argv)
+    for name in args.volumes:
+        if name not in everything:
+            parser.error('no volume called ' + name)
+
+    failed = 0
+    for name in args.volumes or list(everything):
+        pagelist = everything[name]
+        with tempfile.TemporaryDirectory() as scratch:
+            texts = collatedtexts(name, pagelist, scratch)
+
+        if args.update:
+            reference = texts.pop('collate/scan')
+            if any(text != reference for text in texts.values()):
+                print(name + ': the ways of collating it disagree; golden copy not written')
+                failed += 1
+                continue
+            os.makedirs(golden_directory, exist_ok = True)
+            writegolden(name, reference)
+            print(name + ': golden copy written')
+            continue
+
+        golden, goldensections = loadgolden(name)
+        if golden is None:
+            print(name + ': no golden copy (run with --update to make one)')
+            failed += 1
+            continue
+
+        volumefailed = False
+        for way, text in texts.items():
+            found = differences(text, golden, goldensections)
+            if found:
+                volumefailed = True
+                print(name + ' ' + way + ': differs from the golden copy')
+                for message in found:
+                    print('  ' + message)
+            else:
+                print(name + ' ' + way + ': matches')
+        failed += volumefailed
+
+    if args.update or args.volumes:
+        return failed
+
+    for name, check in checks.items():
+        found = check()
+        if found:
+            failed += 1
+            print('check ' + name + ': fails')
+            for message in found[:shown]:
+                print('  ' + message)
+            if len(found) > shown:
+                print('  ... %d more' % (len(found) - shown))
+        else:
+            print('check ' + name + ': passes')
+
+    return failed
+
+if __name__ == '__main__':
+    sys.exit(main())